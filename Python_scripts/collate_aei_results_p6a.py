@@ -5,6 +5,40 @@ import argparse
 import glob
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Per-File AEI Parser (runs in worker threads) ---
+def _parse_aei(file_path):
+    """
+    Extracts (Individual_ID, Cell_Type, AEI) from one REDItools AEI file, or None if it cannot be used.
+    """
+    # Filename format: IID_CT_ALU_ONLY.aei.tsv
+    filename = os.path.basename(file_path)
+    try:
+        # Extract Individual ID (IID) and Cell Type (CT)
+        # Filenames use the format: IID_CT_ALU_ONLY.aei.tsv
+        parts = filename.split('_')
+        individual_id = parts[0]
+        cell_type = parts[1]
+
+        # Read the AEI output file (two columns: Substitution, Index)
+        # The reditools index output is two columns, tab-separated, no header. The file is only a
+        # few lines long, so scan it directly instead of building a DataFrame per file.
+        # Extract the A->G index, which is typically labeled 'G-A' in REDItools
+        # This is the canonical AEI value.
+        with open(file_path) as fh:
+            aei_value = next((float(line.split('\t', 1)[1]) for line in fh if line.startswith('G-A\t')), None)
+        
+        if aei_value is None:
+            # Should not happen if data is correctly generated, but handles edge case
+            print(f"WARNING: 'G-A' substitution not found in {filename}. Skipping.", file=sys.stderr)
+            return None
+
+        return individual_id, cell_type, aei_value
+
+    except Exception as e:
+        print(f"WARNING: Skipping file {filename} due to error: {e}", file=sys.stderr)
+        return None
 
 # --- Main Function ---
 def collate_aei_results(args):
@@ -22,50 +56,18 @@ def collate_aei_results(args):
         return
 
     print(f"Found {len(input_files)} AEI files for collation.")
-    aei_list = []
 
     # 1. Iterate and Extract AEI
-    for i, file_path in enumerate(input_files):
-        try:
-            # Filename format: IID_CT_ALU_ONLY.aei.tsv
-            filename = os.path.basename(file_path)
-            
-            # Extract Individual ID (IID) and Cell Type (CT)
-            # Filenames use the format: IID_CT_ALU_ONLY.aei.tsv
-            parts = filename.split('_')
-            individual_id = parts[0]
-            cell_type = parts[1]
-
-            # Read the AEI output file (two columns: Substitution, Index)
-            # The reditools index output is two columns, tab-separated, no header
-            df_aei = pd.read_csv(file_path, sep='\t', header=None, names=['Substitution', 'Index'])
-            
-            # Extract the A->G index, which is typically labeled 'G-A' in REDItools
-            # This is the canonical AEI value.
-            aei_row = df_aei[df_aei['Substitution'] == 'G-A']
-            
-            if aei_row.empty:
-                # Should not happen if data is correctly generated, but handles edge case
-                print(f"WARNING: 'G-A' substitution not found in {filename}. Skipping.", file=sys.stderr)
-                continue
-                
-            aei_value = aei_row['Index'].iloc[0]
-
-            aei_list.append({
-                'Individual_ID': individual_id,
-                'Cell_Type': cell_type,
-                'AEI': aei_value
-            })
-
-        except Exception as e:
-            print(f"WARNING: Skipping file {filename} due to error: {e}", file=sys.stderr)
+    # The work is many tiny reads, so a thread pool overlaps the filesystem latency
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        records = [r for r in executor.map(_parse_aei, input_files) if r is not None]
 
-    if not aei_list:
+    if not records:
         print("No valid AEI data processed. Exiting.", file=sys.stderr)
         return
 
     # 2. Collate and Pivot to Covariate Format
-    df_raw = pd.DataFrame(aei_list)
+    df_raw = pd.DataFrame.from_records(records, columns=['Individual_ID', 'Cell_Type', 'AEI'])
     
     # Create the final covariate column name: AEI_CellType
     df_raw['Covariate_Name'] = 'AEI_' + df_raw['Cell_Type']
@@ -93,6 +95,7 @@ if __name__ == "__main__":
     parser.add_argument("--input_dir", required=True, help="Directory containing all individual AEI output files.")
     parser.add_argument("--file_pattern", default="*.aei.tsv", help="File pattern to match AEI files.")
     parser.add_argument("--output_file", required=True, help="Path to save the single, final AEI covariate matrix.")
+    parser.add_argument("--threads", type=int, default=64, help="Number of I/O threads used to read the AEI files.")
     args = parser.parse_args()
     
     try:
@@ -5,15 +5,431 @@ import argparse
 import glob
 import sys
 import os
+import re
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from numba import njit, prange
+from pandas.api.types import union_categoricals
+import pyarrow as pa
+from pyarrow import csv as pacsv
+from pyarrow import parquet as pq
+from pyarrow import dataset as ds
+from pyarrow import compute as pc
+from pipeline_common import atomic_output, parquet_output_path, write_matrix_tsv
 
 # This script implements the definitive Li et al. (2022) edQTL feature selection strategy 
 # by collating data across ALL individuals and then selecting the most active site 
 # per (Gene, CellType) feature based on the population median of raw editing ratios.
 
+# --- Reader Options ---
+# PyArrow's multithreaded CSV tokenizer replaces pandas' parser for the Phase 4 matrices.
+# Identifier columns are pinned to string so mixed chromosome names (1..22, X, Y, MT)
+# are never type-inferred differently across read blocks.
+P4_PARSE_OPTIONS = pacsv.ParseOptions(delimiter='\t')
+P4_CONVERT_OPTIONS = pacsv.ConvertOptions(
+    null_values=['NA'],
+    strings_can_be_null=True,
+    column_types={'SiteID': pa.string(), 'Chr': pa.string(), 'Phase3_Gene': pa.string()}
+)
+
+# Only these columns (plus every *_ER column) are needed for collation. GlobalFilterStatus is
+# only evaluated by the PASS filter inside the scan and is never materialized.
+P4_KEY_COLUMNS = ['SiteID', 'Phase3_Gene']
+
+# Part of the --cache_dir key; bump it when the layout of the cached per-individual frames changes
+CACHE_LAYOUT = 'pass-wide-v2'
+
+def er_column_cell_type(col):
+    """Cell type of a Phase 4 editing ratio column (e.g. 'Bcell_ER' -> 'Bcell'); shared by both engines and passes."""
+    return col.replace('_ER', '')
+
+def fresh_phase4_input(parquet_path, parquet_suffix, tsv_suffix):
+    """
+    Returns parquet_path, or its sibling TSV if that is newer: a Parquet copy older than its TSV
+    predates a Phase 4 rerun, so the TSV is read instead, with a warning.
+    """
+    tsv_path = parquet_path[:-len(parquet_suffix)] + tsv_suffix
+    if os.path.exists(tsv_path) and os.path.getmtime(tsv_path) > os.path.getmtime(parquet_path):
+        print(f"WARNING: {parquet_path} is older than {tsv_path}; reading the TSV instead "
+              f"(rerun convert_phase4_to_parquet.py to refresh it).", file=sys.stderr)
+        return tsv_path
+    return parquet_path
+
+def read_phase4_columns(file_path):
+    """Returns the column names of a Phase 4 matrix without parsing its body."""
+    if file_path.endswith('.parquet'):
+        return pq.read_schema(file_path).names
+    with open(file_path) as f:
+        return f.readline().rstrip('\n').split('\t')
+
+def read_phase4_matrix(file_path, columns=None):
+    """
+    Reads the GlobalFilterStatus == 'PASS' rows of a Phase 4 matrix with PyArrow and returns
+    a pandas DataFrame indexed by SiteID. Only `columns` are parsed (default: the key columns
+    plus every *_ER column). The PASS predicate is pushed down into the scan for both TSV
+    and Parquet inputs (see convert_phase4_to_parquet.py), so failed sites are dropped batch
+    by batch and never materialized.
+    """
+    if columns is None:
+        columns = P4_KEY_COLUMNS + [col for col in read_phase4_columns(file_path) if col.endswith('_ER')]
+    # Editing ratios are bounded in [0, 1] and later rank-transformed, so float32 is sufficient
+    er_types = {col: pa.float32() for col in columns if col.endswith('_ER')}
+    if file_path.endswith('.parquet'):
+        table = pq.read_table(file_path, columns=columns, filters=[('GlobalFilterStatus', '=', 'PASS')])
+        table = table.cast(pa.schema([pa.field(f.name, er_types.get(f.name, f.type)) for f in table.schema]))
+    else:
+        csv_format = ds.CsvFileFormat(
+            parse_options=P4_PARSE_OPTIONS,
+            convert_options=pacsv.ConvertOptions(
+                null_values=P4_CONVERT_OPTIONS.null_values,
+                strings_can_be_null=True,
+                column_types={**P4_CONVERT_OPTIONS.column_types, **er_types}
+            )
+        )
+        table = ds.dataset(file_path, format=csv_format).to_table(
+            columns=columns, filter=pc.field('GlobalFilterStatus') == 'PASS'
+        )
+    return table.to_pandas(self_destruct=True).set_index('SiteID')
+
+# --- Parsed-Matrix Cache (--cache_dir) ---
+def _cache_path(file_path, individual_id, cache_dir):
+    """Cache file of a Phase 4 matrix, keyed on its path, modification time and CACHE_LAYOUT."""
+    key = hashlib.blake2b(f"{file_path}:{os.path.getmtime(file_path)}:{CACHE_LAYOUT}".encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{individual_id}_{key}.parquet")
+
+def _parse_phase4_wide(file_path, cache_path=None):
+    """
+    Parses the PASS sites of a Phase 4 matrix that carry a gene annotation, indexed by SiteID
+    with Phase3_Gene plus the float32 *_ER columns. If cache_path is set the frame is also
+    stored there for later passes and reruns.
+    """
+    # --- Essential: Only Sites that Passed Global QC (filter is pushed down into the reader) ---
+    # Sites without a gene annotation cannot form a (Gene, CellType) feature and are dropped.
+    # The reader returns only the gene annotation and the Editing Ratio columns, so the
+    # frame is used as is, without a column-selection copy
+    df_wide = read_phase4_matrix(file_path).dropna(subset=['Phase3_Gene'])
+    if cache_path is not None:
+        with atomic_output(cache_path) as tmp_path:
+            df_wide.to_parquet(tmp_path, compression='zstd')
+    return df_wide
+
+# --- Pass 1: Feature Key Scan (runs in worker processes) ---
+def _scan_keys(file_path, iid_re, cache_dir=None):
+    """
+    Reads only the key columns of a Phase 4 matrix and returns the PASS (SiteID, Phase3_Gene)
+    pairs together with the file's cell types. With cache_dir, a cached matrix supplies the
+    keys without touching the input; otherwise the full matrix is parsed once and cached, so
+    pass 2 reads it back instead of parsing the file again. Returns None if the file cannot
+    be read.
+    """
+    try:
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = _cache_path(file_path, iid_re.search(file_path).group(1), cache_dir)
+        if cache_path is not None and os.path.exists(cache_path):
+            er_cols = [col for col in pq.read_schema(cache_path).names if col.endswith('_ER')]
+            pairs = pd.read_parquet(cache_path, columns=['Phase3_Gene']).reset_index()
+        elif cache_path is not None:
+            df_wide = _parse_phase4_wide(file_path, cache_path)
+            er_cols = df_wide.columns[1:]
+            pairs = df_wide[['Phase3_Gene']].reset_index()
+        else:
+            er_cols = [col for col in read_phase4_columns(file_path) if col.endswith('_ER')]
+            # Only PASS sites are returned by the reader; gene-less sites are dropped as in pass 2
+            pairs = read_phase4_matrix(file_path, columns=P4_KEY_COLUMNS).dropna(subset=['Phase3_Gene']).reset_index()
+        # Categorical keys are much smaller to ship back from the worker than object strings
+        return pairs.astype('category'), [er_column_cell_type(col) for col in er_cols]
+    except Exception as e:
+        print(f"WARNING: Skipping file {file_path} due to error: {e}", file=sys.stderr)
+        return None
+
+# --- Pass 2: Per-File Loader (runs in worker processes) ---
+def _load_one(file_path, iid_re, cache_dir=None):
+    """
+    Loads the PASS sites of a single Phase 4 matrix and returns (individual_id, df_wide),
+    where df_wide is indexed by SiteID and holds Phase3_Gene plus the float32 *_ER columns.
+    The frame stays in its wide (sites x cell types) shape; the caller scatters it into the
+    population matrix by integer row keys, so no long-format table is built.
+    If cache_dir is set, the frame cached by pass 1 (or an earlier run) is reused while the
+    input is unchanged.
+    Returns None if the file cannot be processed.
+    """
+    try:
+        # Extract individual ID from the filename (e.g., IID_final_editing_matrix_p4.tsv -> IID)
+        individual_id = iid_re.search(file_path).group(1)
+
+        # Reuse the cached frame if this exact input was already parsed
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = _cache_path(file_path, individual_id, cache_dir)
+            if os.path.exists(cache_path):
+                return individual_id, pd.read_parquet(cache_path)
+
+        return individual_id, _parse_phase4_wide(file_path, cache_path)
+
+    except Exception as e:
+        print(f"WARNING: Skipping file {file_path} due to error: {e}", file=sys.stderr)
+        return None
+
+# --- Collation Engines ---
+def build_feature_index(site_levels, gene_levels, pair_site_codes, pair_gene_codes, cell_types):
+    """
+    Crosses every sorted (SiteID, Gene) pair, given as codes into the sorted site and gene
+    levels, with every cell type. Combinations that no individual reports stay all-NaN and
+    are removed by the sample size filter. The index is assembled from the level dictionaries
+    and codes, so no string is hashed again.
+    """
+    n_cell_types = len(cell_types)
+    return pd.MultiIndex(
+        levels=[site_levels, gene_levels, pd.Index(cell_types, dtype=object)],
+        codes=[
+            np.repeat(pair_site_codes, n_cell_types),
+            np.repeat(pair_gene_codes, n_cell_types),
+            np.tile(np.arange(n_cell_types), len(pair_site_codes))
+        ],
+        names=['SiteID', 'Phase3_Gene', 'CellType'],
+        verify_integrity=False
+    )
+
+def collate_with_pandas(input_files, iid_re, threads, cache_dir=None):
+    """
+    Builds the population matrix in two passes over the Phase 4 matrices, both run in a
+    process pool:
+      Pass 1 reads only the key columns (from the --cache_dir copies where present) and
+             builds the sorted union of (SiteID, Phase3_Gene, CellType) features.
+      Pass 2 allocates one dense (Features x Individuals) array up front and scatters each
+             individual's wide (sites x cell types) editing ratios into its column by
+             integer row keys (pair_row * n_cell_types + cell_type_pos).
+    This avoids an N-way pd.concat, whose repeated index alignment needs 2-3x the final
+    matrix in memory, as well as any per-file long-format table. Returns None if no file
+    could be loaded.
+    """
+    # Parsing is CPU-bound, so a process pool is used to bypass the GIL. Results are
+    # returned in input order, which keeps the column order identical to a serial run.
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        # Pass 1: union of feature keys
+        print("  Pass 1/2: Scanning feature keys...")
+        pair_frames = []
+        cell_types = set()
+        scanned_files = []
+        for file_path, keys in zip(input_files, executor.map(_scan_keys, input_files, repeat(iid_re), repeat(cache_dir), chunksize=16)):
+            if keys is None:
+                continue
+            pairs, file_cell_types = keys
+            pair_frames.append(pairs)
+            cell_types.update(file_cell_types)
+            scanned_files.append(file_path)
+
+        if not scanned_files:
+            return None
+
+        # Merge the per-file categoricals into one shared, lexically sorted dictionary per key so
+        # that deduplication and sorting run on integer codes instead of strings
+        site_cat = union_categoricals([pairs['SiteID'] for pairs in pair_frames], sort_categories=True)
+        gene_cat = union_categoricals([pairs['Phase3_Gene'] for pairs in pair_frames], sort_categories=True)
+        site_gene_pairs = pd.DataFrame({'SiteID': site_cat.codes, 'Phase3_Gene': gene_cat.codes}).drop_duplicates()
+        site_gene_pairs = site_gene_pairs.sort_values(['SiteID', 'Phase3_Gene'], ignore_index=True)
+        cell_types = sorted(cell_types)
+        n_cell_types = len(cell_types)
+        n_pairs = len(site_gene_pairs)
+
+        feature_index = build_feature_index(site_cat.categories, gene_cat.categories,
+                                            site_gene_pairs['SiteID'].to_numpy(), site_gene_pairs['Phase3_Gene'].to_numpy(),
+                                            cell_types)
+        print(f"  Union of features: {len(feature_index)} ({n_pairs} sites x {n_cell_types} cell types)")
+
+        # Integer keys of the sorted (SiteID, Gene) pairs: sorted by (site code, gene code), so the
+        # combined key is strictly increasing and a file's pairs are located with a binary search
+        site_lookup = site_cat.categories
+        gene_lookup = gene_cat.categories
+        pair_keys = site_gene_pairs['SiteID'].to_numpy(np.int64) * len(gene_lookup) + site_gene_pairs['Phase3_Gene'].to_numpy(np.int64)
+        cell_type_lookup = pd.Index(cell_types, dtype=object)
+
+        # Pass 2: fill the preallocated population matrix column by column
+        print("  Pass 2/2: Loading editing ratios...")
+        values = np.full((len(feature_index), len(scanned_files)), np.nan, dtype=np.float32)
+        individual_ids = []
+        loaded_cols = []
+        results = executor.map(_load_one, scanned_files, repeat(iid_re), repeat(cache_dir), chunksize=16)
+        for i, (file_path, loaded) in enumerate(zip(scanned_files, results)):
+            if (i + 1) % 500 == 0 or i == 0 or i == len(scanned_files) - 1:
+                print(f"  Processed file {i+1}/{len(scanned_files)}: {os.path.basename(file_path)}")
+            if loaded is None:
+                continue
+            individual_id, df_wide = loaded
+            # df_wide is Phase3_Gene followed by the *_ER columns
+            er_cols = df_wide.columns[1:]
+
+            # Row of every (site, cell type) cell of this file in the population matrix
+            file_keys = site_lookup.get_indexer(df_wide.index) * len(gene_lookup) + gene_lookup.get_indexer(df_wide['Phase3_Gene'])
+            pair_rows = np.searchsorted(pair_keys, file_keys)
+            # Every site/gene of pass 2 must be one of the pass 1 pairs; a miss would scatter into another feature's row
+            if (file_keys < 0).any() or not np.array_equal(pair_keys[np.minimum(pair_rows, len(pair_keys) - 1)], file_keys):
+                raise ValueError(f"Sites of {os.path.basename(file_path)} do not match the feature keys scanned in pass 1")
+            cell_type_pos = cell_type_lookup.get_indexer([er_column_cell_type(col) for col in er_cols])
+            if (cell_type_pos < 0).any():
+                raise ValueError(f"Cell types of {os.path.basename(file_path)} do not match the cell types scanned in pass 1")
+            rows = pair_rows[:, np.newaxis] * n_cell_types + cell_type_pos[np.newaxis, :]
+
+            values[rows, i] = df_wide[er_cols].to_numpy(np.float32)
+            individual_ids.append(individual_id)
+            loaded_cols.append(i)
+
+    if not loaded_cols:
+        return None
+
+    if len(loaded_cols) < len(scanned_files):
+        values = values[:, loaded_cols]
+
+    return pd.DataFrame(values, index=feature_index, columns=individual_ids)
+
+def collate_with_polars(input_files, iid_re, threads):
+    """
+    Builds the same population matrix as collate_with_pandas, with all files combined into
+    one Polars lazy query that is run by the streaming engine:
+      Headers are validated up front; a file whose header cannot be read or lacks the key
+             columns is skipped with a warning before it joins the query.
+      Pass 1 collects the sorted, unique (SiteID, Phase3_Gene) pairs of the PASS sites.
+      Pass 2 joins the scans to those pairs, so only integer (pair row, file position) keys
+             and the float32 editing ratios are collected, and scatters them into the
+             preallocated (Features x Individuals) array.
+    No per-individual frame or long-format table with string keys is materialized. A file
+    that is corrupt past its header makes the query fail. Returns None if no file could be
+    scanned.
+    """
+    os.environ.setdefault('POLARS_MAX_THREADS', str(threads))
+    import polars as pl
+
+    scans = []
+    cell_types = set()
+    for file_path in input_files:
+        try:
+            individual_id = iid_re.search(file_path).group(1)
+            if file_path.endswith('.parquet'):
+                lf = pl.scan_parquet(file_path)
+            else:
+                lf = pl.scan_csv(file_path, separator='\t', null_values=['NA'],
+                                 schema_overrides={'SiteID': pl.Utf8, 'Chr': pl.Utf8, 'Phase3_Gene': pl.Utf8})
+            columns = lf.collect_schema().names()
+            missing = [col for col in P4_KEY_COLUMNS + ['GlobalFilterStatus'] if col not in columns]
+            if missing:
+                raise ValueError(f"missing columns {missing}")
+            er_cols = {er_column_cell_type(col): col for col in columns if col.endswith('_ER')}
+            scans.append((individual_id, lf, er_cols))
+            cell_types.update(er_cols)
+        except Exception as e:
+            print(f"WARNING: Skipping file {file_path} due to error: {e}", file=sys.stderr)
+
+    if not scans:
+        return None
+
+    # Every file is projected onto one shared schema: the key columns, its position among the
+    # scanned files in place of an ID string, and one Float32 column per cell type (null where absent)
+    cell_types = sorted(cell_types)
+    n_cell_types = len(cell_types)
+    combined = pl.concat([
+        lf.filter((pl.col('GlobalFilterStatus') == 'PASS') & pl.col('Phase3_Gene').is_not_null())
+          .select(P4_KEY_COLUMNS
+                  + [pl.lit(pos, dtype=pl.UInt32).alias('File')]
+                  + [pl.col(er_cols[ct]).cast(pl.Float32).alias(ct) if ct in er_cols
+                     else pl.lit(None, dtype=pl.Float32).alias(ct) for ct in cell_types])
+        for pos, (_, lf, er_cols) in enumerate(scans)
+    ], how='vertical')
+
+    # Pass 1: union of feature keys
+    print(f"  Pass 1/2: Scanning feature keys of {len(scans)} files...")
+    pairs = combined.select(P4_KEY_COLUMNS).unique().sort(P4_KEY_COLUMNS).collect(engine='streaming')
+    site_codes, site_levels = pd.factorize(pairs['SiteID'].to_numpy(), sort=True)
+    gene_codes, gene_levels = pd.factorize(pairs['Phase3_Gene'].to_numpy(), sort=True)
+    feature_index = build_feature_index(site_levels, gene_levels, site_codes, gene_codes, cell_types)
+    print(f"  Union of features: {len(feature_index)} ({len(pairs)} sites x {n_cell_types} cell types)")
+
+    # Pass 2: the string keys are resolved to pair rows inside the query
+    print("  Pass 2/2: Loading editing ratios...")
+    entries = (
+        combined.join(pairs.with_row_index('Row').lazy(), on=P4_KEY_COLUMNS, how='inner')
+                .select(['Row', 'File'] + cell_types)
+                .collect(engine='streaming')
+    )
+    del pairs
+    values = np.full((len(feature_index), len(scans)), np.nan, dtype=np.float32)
+    rows = entries['Row'].to_numpy().astype(np.int64) * n_cell_types
+    files = entries['File'].to_numpy()
+    for pos, cell_type in enumerate(cell_types):
+        values[rows + pos, files] = entries[cell_type].to_numpy()
+
+    return pd.DataFrame(values, index=feature_index, columns=[individual_id for individual_id, _, _ in scans])
+
+# --- Numba Selection Kernels ---
+@njit(cache=True)
+def _nanmedian_into(row, buf):
+    """Median of the non-NaN entries of `row`, using `buf` as quickselect scratch space (NaN if none)."""
+    n = 0
+    for j in range(row.shape[0]):
+        if not np.isnan(row[j]):
+            buf[n] = row[j]
+            n += 1
+    if n == 0:
+        return np.nan
+
+    # Hoare quickselect for the upper middle element; everything left of k ends up <= buf[k]
+    k = n // 2
+    lo, hi = 0, n - 1
+    while lo < hi:
+        pivot = buf[(lo + hi) // 2]
+        i, j = lo, hi
+        while i <= j:
+            while buf[i] < pivot:
+                i += 1
+            while buf[j] > pivot:
+                j -= 1
+            if i <= j:
+                buf[i], buf[j] = buf[j], buf[i]
+                i += 1
+                j -= 1
+        if k <= j:
+            hi = j
+        elif k >= i:
+            lo = i
+        else:
+            break
+    upper = buf[k]
+    if n % 2 == 1:
+        return upper
+
+    # Even count: the lower middle element is the largest value left of k
+    lower = buf[0]
+    for t in range(1, k):
+        if buf[t] > lower:
+            lower = buf[t]
+    return 0.5 * (lower + upper)
+
+@njit(parallel=True, cache=True)
+def _select_max_median(values, order, starts):
+    """
+    Fused median + group argmax over a C-contiguous (Features x Individuals) array.
+    Rows order[starts[g]:starts[g+1]] form group g; returns, per group, the row with the
+    highest median (first one in `order` on ties). Groups run in parallel.
+    """
+    n_groups = starts.shape[0] - 1
+    best_rows = np.empty(n_groups, dtype=np.int64)
+    for g in prange(n_groups):
+        buf = np.empty(values.shape[1], dtype=np.float64)
+        best_row = order[starts[g]]
+        best_median = -np.inf
+        for k in range(starts[g], starts[g + 1]):
+            median = _nanmedian_into(values[order[k]], buf)
+            if median > best_median:
+                best_median = median
+                best_row = order[k]
+        best_rows[g] = best_row
+    return best_rows
+
 # --- Main Function ---
 def run_phase5_collation_and_selection(args):
     """
-    1. Loads all individual Phase 4 matrices.
+    1. Loads all individual Phase 4 matrices (pandas process pool or Polars lazy scan).
     2. Collates them into a single population-level table (long format).
     3. **APPLIES SAMPLE SIZE FILTER (N >= args.min_samples)**.
     4. Performs the Representative Site selection (highest median raw ER) 
@@ -21,59 +437,42 @@ def run_phase5_collation_and_selection(args):
     """
     MIN_SAMPLES = args.min_samples # Now read from argparse
     
-    input_pattern = os.path.join(args.input_dir, args.file_pattern)
+    # Parquet copies of the Phase 4 matrices share the TSV file names apart from the extension
+    file_pattern = args.file_pattern
+    if args.use_parquet:
+        file_pattern = file_pattern.replace('.tsv', '.parquet')
+    
+    input_pattern = os.path.join(args.input_dir, file_pattern)
+
+    # Individual ID = file name minus the pattern suffix (e.g., IID_final_editing_matrix_p4.tsv -> IID).
+    # Both suffixes are accepted, since a stale Parquet copy is replaced by its TSV below.
+    # Compiled once here and shipped to the workers instead of rebuilding the suffix per file.
+    tsv_suffix = args.file_pattern.replace("*", "")
+    parquet_suffix = file_pattern.replace("*", "")
+    iid_re = re.compile(rf'([^/]+)(?:{re.escape(tsv_suffix)}|{re.escape(parquet_suffix)})$')
     input_files = glob.glob(input_pattern)
     
     if not input_files:
         print(f"FATAL ERROR: No files found matching pattern: {input_pattern}", file=sys.stderr)
         return
 
-    print(f"Found {len(input_files)} individual files for collation.")
-    all_data = []
+    if args.use_parquet:
+        input_files = [fresh_phase4_input(path, parquet_suffix, tsv_suffix) for path in input_files]
 
-    # 1. Collation (Iterate and Stack) - Converting from wide (by CellType) to long (by Sample/Individual)
-    for i, file_path in enumerate(input_files):
-        if (i + 1) % 500 == 0 or i == 0 or i == len(input_files) - 1:
-            print(f"  Processing file {i+1}/{len(input_files)}: {os.path.basename(file_path)}")
-        try:
-            # Read the Phase 4 file
-            df = pd.read_csv(file_path, sep='\t', index_col='SiteID', na_values=['NA'])
-            
-            # --- Essential: Filter for Sites that Passed Global QC ---
-            df_filtered = df[df['GlobalFilterStatus'] == 'PASS'].copy()
-            
-            # Extract individual ID from the filename (e.g., IID_final_editing_matrix_p4.tsv -> IID)
-            individual_id = os.path.basename(file_path).replace(args.file_pattern.replace('*', ''), '')
-            
-            # Identify relevant columns (Editing Ratios and Gene annotation)
-            er_cols = [col for col in df_filtered.columns if col.endswith('_ER')]
-            metadata_cols = ['Phase3_Gene']
-            
-            # Convert the individual's wide table to long format
-            df_long = df_filtered[metadata_cols + er_cols].reset_index().melt(
-                id_vars=['SiteID', 'Phase3_Gene'], 
-                value_vars=er_cols, 
-                var_name='CellType_ER', 
-                value_name=individual_id
-            )
-            
-            # Clean up and prepare the long format for merging
-            df_long['CellType'] = df_long['CellType_ER'].str.replace('_ER', '')
-            df_long = df_long.drop(columns=['CellType_ER'])
-            
-            # Set index for robust merging: (SiteID, Gene, CellType)
-            df_long.set_index(['SiteID', 'Phase3_Gene', 'CellType'], inplace=True)
-            all_data.append(df_long[[individual_id]])
+    print(f"Found {len(input_files)} individual files for collation (engine: {args.engine}, threads: {args.threads}).")
 
-        except Exception as e:
-            print(f"WARNING: Skipping file {file_path} due to error: {e}", file=sys.stderr)
+    if args.cache_dir is not None:
+        os.makedirs(args.cache_dir, exist_ok=True)
+
+    # 1. Collation (Load and Stack) - Converting from wide (by CellType) to long (by Sample/Individual)
+    if args.engine == 'polars':
+        population_matrix_raw = collate_with_polars(input_files, iid_re, args.threads)
+    else:
+        population_matrix_raw = collate_with_pandas(input_files, iid_re, args.threads, args.cache_dir)
 
-    if not all_data:
+    if population_matrix_raw is None:
         print("No data successfully processed. Exiting.", file=sys.stderr)
         return
-
-    # Combine all long dataframes into one massive population matrix
-    population_matrix_raw = pd.concat(all_data, axis=1)
     
     print(f"\n--- Collation Complete ---")
     print(f"Raw population matrix shape: {population_matrix_raw.shape}")
@@ -81,53 +480,73 @@ def run_phase5_collation_and_selection(args):
     # 2. **Sample Size Filter (NEW STEP)**
     print(f"Applying Sample Size Filter: Keeping features with N >= {MIN_SAMPLES} samples...")
     
+    # From here on the work is row-wise over features, so drop to a C-contiguous (row-major)
+    # float32 array once: each feature's values are then adjacent in memory for the row kernels
+    values = np.ascontiguousarray(population_matrix_raw.to_numpy(dtype=np.float32))
+    
     # Count the number of non-missing values (samples) for each feature (row)
-    sample_counts = population_matrix_raw.notna().sum(axis=1)
+    sample_counts = np.count_nonzero(~np.isnan(values), axis=1)
     
-    # Filter the matrix
-    population_matrix_filtered = population_matrix_raw[sample_counts >= MIN_SAMPLES]
+    # Filter the matrix (features with no observed sample at all are never retained). Features without
+    # a gene (code -1) cannot form a (Gene, CellType) group and are dropped, as a groupby would
+    gene_level = population_matrix_raw.index.names.index('Phase3_Gene')
+    keep = (sample_counts >= max(MIN_SAMPLES, 1)) & (population_matrix_raw.index.codes[gene_level] >= 0)
+    values = values[keep]
+    feature_index = population_matrix_raw.index[keep]
     
-    print(f"Filtered matrix shape (Features x Individuals): {population_matrix_filtered.shape}")
+    print(f"Filtered matrix shape (Features x Individuals): {values.shape}")
 
     # 3. Population-Level Feature Selection (Li Strategy: Highest Median Raw ER)
     
     print("Performing feature selection: Highest median raw ER per (Gene, CellType)...")
     
-    # Calculate the median editing ratio across ALL individuals (axis=1) for each feature
-    population_matrix_filtered['Median_Raw_ER_Population'] = population_matrix_filtered.median(axis=1)
-
-    # Reset index to access Gene and CellType columns for grouping
-    df_selection = population_matrix_filtered.reset_index()
+    # Combine the (Gene, CellType) index codes into one integer group id; both engines build the
+    # index with lexically sorted levels, so the groups keep the (Gene, CellType) order of a pandas groupby
+    gene_codes = feature_index.codes[feature_index.names.index('Phase3_Gene')]
+    cell_type_level = feature_index.names.index('CellType')
+    cell_type_codes = feature_index.codes[cell_type_level]
+    group_id = gene_codes.astype(np.int64) * len(feature_index.levels[cell_type_level]) + cell_type_codes
 
-    # Find the row index (idx) that has the maximum median within each (Gene, CellType) group
-    idx_max = df_selection.groupby(['Phase3_Gene', 'CellType'])['Median_Raw_ER_Population'].idxmax()
+    # Stable sort of the rows by group gives contiguous group segments (original order kept within a group);
+    # rows that already arrive clustered by group are used in place, without the sort
+    if np.all(group_id[1:] >= group_id[:-1]):
+        order = np.arange(len(group_id))
+    else:
+        order = np.argsort(group_id, kind='stable')
+    # The prepended sentinel is one below the first group id, so it can never equal a real group
+    sorted_groups = group_id[order]
+    starts = np.append(np.flatnonzero(np.diff(sorted_groups, prepend=sorted_groups[:1] - 1)), len(order))
 
-    # Select the representative rows using these indices
-    final_features_df = df_selection.loc[idx_max]
+    # Fused pass: the median editing ratio across ALL individuals is computed per feature and the
+    # highest-median feature of each (Gene, CellType) group is kept, without materializing the medians
+    idx_max = _select_max_median(values, order, starts)
 
     # --- 4. Final Matrix Restructuring ---
     
-    # Create the final feature identifier (e.g., APP__Bcell)
-    final_features_df['FeatureID'] = final_features_df['Phase3_Gene'] + '__' + final_features_df['CellType']
+    # Create the final feature identifier (e.g., APP__Bcell) straight from the index levels
+    # of the selected rows (only this small slice is wrapped back into a DataFrame)
+    selected_index = feature_index[idx_max]
+    feature_ids = selected_index.get_level_values('Phase3_Gene') + '__' + selected_index.get_level_values('CellType')
     
-    # Drop the temporary grouping/metadata columns
-    final_features_df = final_features_df.drop(columns=['SiteID', 'Phase3_Gene', 'CellType', 'Median_Raw_ER_Population'])
-    
-    # Set the FeatureID as the index. The columns are still Individual IDs.
-    final_edQTL_matrix = final_features_df.set_index('FeatureID')
-    
-    # The final edQTL matrix must have Features as rows and Individuals as columns (N_Features x N_Individuals)
-    final_edQTL_matrix = final_edQTL_matrix.T.T
-    
-    # Ensure the index is named correctly
-    final_edQTL_matrix.index.name = 'FeatureID'
+    # The FeatureID is the index and the columns are still Individual IDs, so the matrix
+    # is already Features x Individuals (N_Features x N_Individuals)
+    final_edQTL_matrix = pd.DataFrame(
+        values[idx_max],
+        index=pd.Index(feature_ids, name='FeatureID'),
+        columns=population_matrix_raw.columns
+    )
 
     # 5. Final Output
     print(f"Final edQTL Feature Matrix shape (Features x Individuals): {final_edQTL_matrix.shape}")
     print(f"Saving final matrix to: {args.output_file}")
     
     # Save the matrix. The values are the raw editing ratios, ready for external INT in Phase 6.
-    final_edQTL_matrix.to_csv(args.output_file, sep='\t', index=True, na_rep='NA')
+    write_matrix_tsv(final_edQTL_matrix, args.output_file, null_string='NA')
+
+    # Optional Parquet copy (the TSV remains the Phase 6 input)
+    if args.write_parquet:
+        final_edQTL_matrix.to_parquet(parquet_output_path(args.output_file), compression='zstd')
+        print(f"Saved Parquet copy to: {parquet_output_path(args.output_file)}")
 
 # --- Main Execution ---
 if __name__ == "__main__":
@@ -136,6 +555,11 @@ if __name__ == "__main__":
     parser.add_argument("--file_pattern", default="*_final_editing_matrix_p4.tsv", help="File pattern to match Phase 4 matrices.")
     parser.add_argument("--output_file", required=True, help="Path to save the single, final edQTL feature matrix.")
     parser.add_argument("--min_samples", type=int, required=True, help="Minimum number of non-missing samples required for a feature to be retained (e.g., 70).")
+    parser.add_argument("--use_parquet", action="store_true", help="Read Parquet copies of the Phase 4 matrices (written by convert_phase4_to_parquet.py) instead of the TSVs.")
+    parser.add_argument("--engine", choices=['pandas', 'polars'], default='pandas', help="Collation engine. 'polars' scans and PASS-filters all files as one streaming lazy query.")
+    parser.add_argument("--cache_dir", default=None, help="Optional directory for a Parquet cache of the parsed per-individual matrices (pandas engine). Unchanged inputs are not re-parsed on reruns.")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(), help="Number of worker processes (pandas) or threads (polars) used to load the Phase 4 matrices.")
+    parser.add_argument("--write_parquet", action="store_true", help="Also write a zstd-compressed Parquet copy of the feature matrix (same name, .parquet extension).")
     args = parser.parse_args()
     
     try:
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import argparse
+import glob
+import sys
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import pyarrow as pa
+from pyarrow import csv as pacsv
+from pyarrow import parquet as pq
+from pipeline_common import atomic_output
+
+# One-shot converter that writes a Parquet copy of every Phase 4 matrix next to the TSV
+# (or into --output_dir). Phase 5 reads these with --use_parquet, which skips text parsing
+# and pushes the column projection and the PASS filter into the reader.
+
+P4_PARSE_OPTIONS = pacsv.ParseOptions(delimiter='\t')
+P4_CONVERT_OPTIONS = pacsv.ConvertOptions(
+    null_values=['NA'],
+    strings_can_be_null=True,
+    column_types={'SiteID': pa.string(), 'Chr': pa.string(), 'Phase3_Gene': pa.string()}
+)
+
+# --- Per-File Conversion (runs in worker processes) ---
+def parquet_copy_path(file_path, output_dir):
+    """Path of the Parquet copy of a Phase 4 TSV in output_dir."""
+    return os.path.join(output_dir, os.path.basename(file_path).replace('.tsv', '.parquet'))
+
+def convert_one(file_path, output_dir):
+    """Converts a single Phase 4 TSV to Parquet. Returns the output path, or None on failure."""
+    try:
+        output_path = parquet_copy_path(file_path, output_dir)
+        table = pacsv.read_csv(file_path, parse_options=P4_PARSE_OPTIONS, convert_options=P4_CONVERT_OPTIONS)
+        # An interrupted run must not leave a partial copy that looks up to date
+        with atomic_output(output_path) as tmp_path:
+            pq.write_table(table, tmp_path, compression='zstd', row_group_size=50_000)
+        return output_path
+    except Exception as e:
+        print(f"WARNING: Failed to convert {file_path}: {e}", file=sys.stderr)
+        return None
+
+# --- Main Function ---
+def convert_phase4_to_parquet(args):
+    """
+    1. Finds all Phase 4 matrices matching the file pattern.
+    2. Writes a zstd-compressed Parquet copy of each one, skipping copies that are
+       already newer than their TSV.
+    """
+    input_pattern = os.path.join(args.input_dir, args.file_pattern)
+    input_files = glob.glob(input_pattern)
+
+    if not input_files:
+        print(f"FATAL ERROR: No files found matching pattern: {input_pattern}", file=sys.stderr)
+        sys.exit(1)
+
+    output_dir = args.output_dir or args.input_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    # A copy at least as new as its TSV is up to date (same rule as the GTF/REDIPortal caches)
+    n_found = len(input_files)
+    input_files = [f for f in input_files
+                   if not (os.path.exists(parquet_copy_path(f, output_dir))
+                           and os.path.getmtime(parquet_copy_path(f, output_dir)) >= os.path.getmtime(f))]
+    if len(input_files) < n_found:
+        print(f"Skipping {n_found - len(input_files)} matrices whose Parquet copy is up to date.")
+    if not input_files:
+        return
+
+    print(f"Converting {len(input_files)} Phase 4 matrices to Parquet in: {output_dir}")
+    with ProcessPoolExecutor(max_workers=args.threads) as executor:
+        results = list(executor.map(convert_one, input_files, repeat(output_dir), chunksize=16))
+
+    n_failed = sum(1 for r in results if r is None)
+    print(f"Converted {len(results) - n_failed}/{len(results)} files ({n_failed} failed).")
+    if n_failed:
+        sys.exit(1)
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert Phase 4 editing matrices from TSV to Parquet for faster Phase 5 collation.")
+    parser.add_argument("--input_dir", required=True, help="Directory containing all Phase 4 output matrices.")
+    parser.add_argument("--file_pattern", default="*_final_editing_matrix_p4.tsv", help="File pattern to match Phase 4 matrices.")
+    parser.add_argument("--output_dir", default=None, help="Directory for the Parquet files (defaults to --input_dir).")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    args = parser.parse_args()
+
+    try:
+        convert_phase4_to_parquet(args)
+    except Exception as e:
+        print(f"\nFATAL UNCAUGHT ERROR in Phase 4 Parquet Conversion: {e}", file=sys.stderr)
+        sys.exit(1)
@@ -3,28 +3,177 @@ import pandas as pd
 import numpy as np
 import argparse
 import sys
-import os
-from scipy.stats import rankdata
-from scipy.special import ndtr
+import math
+from numba import njit, prange
+import pyarrow as pa
+from pyarrow import csv as pacsv
+from pipeline_common import parquet_output_path, write_matrix_tsv
+
+# --- Numba INT Kernels ---
+# Coefficients of Acklam's rational approximation to the inverse Normal CDF
+ACKLAM_A = (-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+            1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00)
+ACKLAM_B = (-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+            6.680131188771972e+01, -1.328068155288572e+01)
+ACKLAM_C = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+            -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00)
+ACKLAM_D = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00,
+            3.754408661907416e+00)
+ACKLAM_P_LOW = 0.02425
+
+@njit(cache=True)
+def _ndtri(p):
+    """Inverse Normal CDF: Acklam's approximation refined by one Halley step (full double precision)."""
+    a, b, c, d = ACKLAM_A, ACKLAM_B, ACKLAM_C, ACKLAM_D
+    if p < ACKLAM_P_LOW:
+        q = math.sqrt(-2.0 * math.log(p))
+        x = (((((c[0]*q + c[1])*q + c[2])*q + c[3])*q + c[4])*q + c[5]) / \
+            ((((d[0]*q + d[1])*q + d[2])*q + d[3])*q + 1.0)
+    elif p <= 1.0 - ACKLAM_P_LOW:
+        q = p - 0.5
+        r = q * q
+        x = (((((a[0]*r + a[1])*r + a[2])*r + a[3])*r + a[4])*r + a[5])*q / \
+            (((((b[0]*r + b[1])*r + b[2])*r + b[3])*r + b[4])*r + 1.0)
+    else:
+        q = math.sqrt(-2.0 * math.log(1.0 - p))
+        x = -(((((c[0]*q + c[1])*q + c[2])*q + c[3])*q + c[4])*q + c[5]) / \
+             ((((d[0]*q + d[1])*q + d[2])*q + d[3])*q + 1.0)
+
+    e = 0.5 * math.erfc(-x / math.sqrt(2.0)) - p
+    u = e * math.sqrt(2.0 * math.pi) * math.exp(0.5 * x * x)
+    return x - u / (1.0 + 0.5 * x * u)
+
+@njit(cache=True)
+def _int_score(rank_sum, n):
+    """INT score of a tie-run spanning sorted positions k..m of n observations, with rank_sum = k + m."""
+    avg_rank = 0.5 * rank_sum + 1.0
+    # Upper half: use the symmetry ndtri(p) = -ndtri(1 - p) with 1 - p formed exactly from
+    # the ranks, so the upper tail keeps full precision instead of losing it to 1 - p cancellation
+    if 2.0 * avg_rank - 1.0 > n:
+        return -_ndtri((n - avg_rank + 0.5) / n)
+    return _ndtri((avg_rank - 0.5) / n)
+
+@njit(parallel=True, cache=True)
+def _int_score_tables(sample_sizes):
+    """
+    Precomputes the INT score of every possible tie-run for each distinct sample size n:
+    a run's score depends only on n and k + m (0 .. 2n - 2), so one table of 2n - 1 scores
+    per n serves every feature with n observations. Returns (offsets, scores); the table of
+    sample_sizes[g] is scores[offsets[g]:offsets[g + 1]].
+    """
+    offsets = np.zeros(sample_sizes.shape[0] + 1, dtype=np.int64)
+    for g in range(sample_sizes.shape[0]):
+        offsets[g + 1] = offsets[g] + 2 * sample_sizes[g] - 1
+    scores = np.empty(offsets[-1], dtype=np.float64)
+    for g in prange(sample_sizes.shape[0]):
+        for rank_sum in range(2 * sample_sizes[g] - 1):
+            scores[offsets[g] + rank_sum] = _int_score(rank_sum, sample_sizes[g])
+    return offsets, scores
+
+@njit(parallel=True, cache=True)
+def _int_rows(arr, out, use_tables, sample_sizes, offsets, scores):
+    """
+    Row-wise INT of a C-contiguous (Features x Individuals) array, parallel across features.
+    Ties receive their average rank; NaNs are skipped and written back as NaN. With use_tables,
+    scores are looked up in the per-sample-size tables from _int_score_tables; otherwise each
+    tie-run's score is computed directly (the tables are then ignored and may be empty).
+    """
+    n_rows, n_cols = arr.shape
+    for i in prange(n_rows):
+        row = arr[i]
+
+        # Gather the observed (non-NaN) entries of this feature
+        obs_idx = np.empty(n_cols, dtype=np.int64)
+        n = 0
+        for j in range(n_cols):
+            if np.isnan(row[j]):
+                out[i, j] = np.nan
+            else:
+                obs_idx[n] = j
+                n += 1
+        if n == 0:
+            continue
+
+        vals = np.empty(n, dtype=arr.dtype)
+        for k in range(n):
+            vals[k] = row[obs_idx[k]]
+        order = np.argsort(vals, kind='mergesort')
+        table = scores[offsets[np.searchsorted(sample_sizes, n)]:] if use_tables else scores
+
+        # Walk tie-runs in sorted order; every member of a run gets the run's average-rank score
+        k = 0
+        while k < n:
+            m = k
+            while m + 1 < n and vals[order[m + 1]] == vals[order[k]]:
+                m += 1
+            z = table[k + m] if use_tables else _int_score(k + m, n)
+            for t in range(k, m + 1):
+                out[i, obs_idx[order[t]]] = z
+            k = m + 1
+
+# --- Core INT Functions ---
+# Features are transformed in row blocks so only one block is ever held in transposed form
+INT_BLOCK_SIZE = 10_000
+
+def inverse_normal_transform_matrix(values, block_size=INT_BLOCK_SIZE):
+    """
+    Applies Inverse Normal Transformation (INT) to every column of a 2-D
+    (Individuals x Features) array, in parallel across features.
+    
+    Equivalent to: norm.ppf((rank(X, ties='average') - 0.5) / n), per column.
+    Missing values (NaN) are excluded from ranking and remain NaN, so each feature
+    is transformed over its own n non-missing individuals.
+    Features are processed in blocks of `block_size`, which bounds the temporary
+    (Features x Individuals) copy to one block regardless of the matrix size.
+    """
+    # The kernel walks one feature per row, so each block is laid out with features as contiguous rows.
+    # float32 input is kept as float32 (ranks and ndtri are still evaluated in float64).
+    arr = np.asarray(values)
+    if arr.dtype not in (np.float32, np.float64):
+        arr = arr.astype(np.float64)
+    n_features = arr.shape[1]
+    out = np.empty((n_features, arr.shape[0]), dtype=arr.dtype)
+    for start in range(0, n_features, block_size):
+        stop = min(start + block_size, n_features)
+        block = np.ascontiguousarray(arr[:, start:stop].T)
+        # Features sharing a sample size share one score table, so ndtri runs O(n) times per distinct n.
+        # The tables hold 2n - 1 scores per distinct n; they are only built when that is no more than
+        # the block's observed entries, so many distinct sample sizes cannot outgrow the block itself.
+        observed_counts = np.count_nonzero(~np.isnan(block), axis=1)
+        sample_sizes = np.unique(observed_counts).astype(np.int64)
+        sample_sizes = sample_sizes[sample_sizes > 0]
+        use_tables = int((2 * sample_sizes - 1).sum()) <= int(observed_counts.sum())
+        if use_tables:
+            offsets, scores = _int_score_tables(sample_sizes)
+        else:
+            offsets, scores = np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.float64)
+        _int_rows(block, out[start:stop], use_tables, sample_sizes, offsets, scores)
+    return out.T
 
-# --- Core INT Function ---
 def inverse_normal_transform(data):
     """
     Applies Inverse Normal Transformation (INT) to a single array (column).
-    INT converts the data to a normal distribution.
-    
-    Equivalent to: norm.ppf((rank(X, ties='average') - 0.5) / n)
+    Thin wrapper around inverse_normal_transform_matrix.
     """
-    # 1. Rank the data (average rank for ties)
-    ranked_data = rankdata(data, method='average')
-    
-    # 2. Normalize ranks to range [0, 1]
-    n = len(data)
-    normalized_ranks = (ranked_data - 0.5) / n
-    
-    # 3. Apply the inverse of the Normal Cumulative Distribution Function (CDF)
-    # ndtr is the Normal CDF, so we use it on the normalized ranks to get the transformed value
-    return ndtr(normalized_ranks)
+    return inverse_normal_transform_matrix(np.asarray(data, dtype=np.float64)[:, np.newaxis])[:, 0]
+
+# --- Input Reader ---
+# Per-individual tables share one layout: an Individual_ID key column followed by numeric columns.
+# The ID is pinned to string so numeric-looking IDs are never type-inferred.
+INPUT_PARSE_OPTIONS = pacsv.ParseOptions(delimiter='\t')
+INPUT_CONVERT_OPTIONS = pacsv.ConvertOptions(
+    null_values=['', 'NA', 'NaN', 'nan', 'N/A', 'NULL', 'null'],
+    strings_can_be_null=True,
+    column_types={'Individual_ID': pa.string()}
+)
+
+def read_individual_matrix(input_path):
+    """
+    Reads a per-individual TSV (Individual_ID as the index) with the multithreaded PyArrow
+    CSV reader instead of pd.read_csv, returning float32 values.
+    """
+    table = pacsv.read_csv(input_path, parse_options=INPUT_PARSE_OPTIONS, convert_options=INPUT_CONVERT_OPTIONS)
+    return table.to_pandas(self_destruct=True).set_index('Individual_ID').astype(np.float32)
 
 # --- Main Function ---
 def run_normalization_and_merge(args):
@@ -39,18 +188,20 @@ def run_normalization_and_merge(args):
     # 1. Load Feature Matrix (Phenotype)
     try:
         # Features are columns (Edit_Site__CellType), Individuals are rows (Index)
-        df_phenotype = pd.read_csv(args.input_features, sep='\t', index_col='Individual_ID')
+        # Editing ratios are bounded in [0, 1] and rank-transformed, so float32 halves memory at no cost
+        df_phenotype = read_individual_matrix(args.input_features)
         print(f"Loaded feature matrix: {df_phenotype.shape}")
     except Exception as e:
         print(f"FATAL ERROR loading feature file: {e}", file=sys.stderr)
         sys.exit(1)
 
     # 2. Load Covariate Matrices
+    # AEI, PCs and PEER factors are only used as regression covariates, so they are held as float32 too
     covariates = []
     
     # 2a. Load AEI Covariates (from AEI_calculation phase)
     try:
-        df_aei = pd.read_csv(args.input_aei_covariates, sep='\t', index_col='Individual_ID')
+        df_aei = read_individual_matrix(args.input_aei_covariates)
         df_aei = df_aei.dropna(axis=1, how='all') # Drop any columns that are all NA
         print(f"Loaded AEI covariates: {df_aei.shape}")
         covariates.append(df_aei)
@@ -60,7 +211,7 @@ def run_normalization_and_merge(args):
         
     # 2b. Load Genotype PCs (Placeholder)
     try:
-        df_pcs = pd.read_csv(args.input_genotype_pcs, sep='\t', index_col='Individual_ID')
+        df_pcs = read_individual_matrix(args.input_genotype_pcs)
         print(f"Loaded Genotype PCs: {df_pcs.shape}")
         covariates.append(df_pcs)
     except Exception as e:
@@ -68,23 +219,36 @@ def run_normalization_and_merge(args):
         
     # 2c. Load PEER Factors (Placeholder - assuming K=60 factors)
     try:
-        df_peer = pd.read_csv(args.input_peer_factors, sep='\t', index_col='Individual_ID')
+        df_peer = read_individual_matrix(args.input_peer_factors)
         print(f"Loaded PEER Factors: {df_peer.shape}")
         covariates.append(df_peer)
     except Exception as e:
         print(f"WARNING: PEER Factors file not found or failed to load ({e}). Skipping.")
         
     # 3. Merge Covariates
-    # Use outer merge to keep all individuals, filling missing covariate values with 0
-    df_covariates_merged = pd.concat(covariates, axis=1)
-    # Filter individuals to those present in the phenotype data
-    individuals = df_phenotype.index.intersection(df_covariates_merged.index)
+    # Keep every phenotyped individual present in at least one covariate table (outer merge semantics).
+    # The common index is computed once; each table's rows are then copied into their slots of one
+    # preallocated zero buffer, so individuals missing from a table are zero without a NaN intermediate.
+    covariate_individuals = covariates[0].index.append([df.index for df in covariates[1:]]).unique()
+    individuals = df_phenotype.index.intersection(covariate_individuals)
+    
+    df_phenotype = df_phenotype.reindex(individuals)
+    covariate_columns = covariates[0].columns.append([df.columns for df in covariates[1:]])
+    covariate_values = np.zeros((len(individuals), len(covariate_columns)), dtype=np.float32)
+    col_start = 0
+    for df in covariates:
+        row_idx = individuals.get_indexer(df.index)
+        present = row_idx >= 0
+        covariate_values[row_idx[present], col_start:col_start + df.shape[1]] = df.to_numpy(dtype=np.float32)[present]
+        col_start += df.shape[1]
     
-    df_phenotype = df_phenotype.loc[individuals]
-    df_covariates_final = df_covariates_merged.loc[individuals].fillna(0) # Treat missing covariates as zero effect
+    # Treat missing covariates (NA inside a table) as zero effect, in place on the buffer
+    covariate_values[np.isnan(covariate_values)] = 0
 
-    # Drop columns from the covariate matrix that have no variation (e.g., all 0)
-    df_covariates_final = df_covariates_final.loc[:, df_covariates_final.nunique() > 1]
+    # Drop columns from the covariate matrix that have no variation (e.g., all 0).
+    # The covariates are NaN-free now, so max > min is one vectorized reduction
+    keep = covariate_values.max(axis=0, initial=-np.inf) > covariate_values.min(axis=0, initial=np.inf)
+    df_covariates_final = pd.DataFrame(covariate_values[:, keep], index=individuals, columns=covariate_columns[keep])
     
     print(f"Final merged and filtered Covariates: {df_covariates_final.shape}")
     print(f"Final Phenotype matrix to transform: {df_phenotype.shape}")
@@ -92,24 +256,35 @@ def run_normalization_and_merge(args):
     # 4. Apply Inverse Normal Transformation (INT)
     print("Applying Inverse Normal Transformation (INT) to all feature columns...")
     
-    # Apply INT column-wise (axis=0)
-    df_phenotype_int = df_phenotype.apply(inverse_normal_transform, axis=0)
+    # Apply INT column-wise (axis=0) as one vectorized operation over the whole matrix.
+    # The kernel works on the raw float32 ndarray; pandas only wraps the final result.
+    phenotype_int_values = inverse_normal_transform_matrix(df_phenotype.to_numpy(dtype=np.float32, copy=False))
 
     # 5. Save Outputs (FastQTL format)
     
     # a. Phenotype Matrix (Features are now rows, Individuals are columns - FastQTL format)
-    # The INT matrix must be transposed for FastQTL
-    df_phenotype_int_fastqtl = df_phenotype_int.T
-    df_phenotype_int_fastqtl.index.name = 'feature_id'
+    # The INT matrix must be transposed for FastQTL; the kernel's output is already stored
+    # feature-major, so this transpose is a free view
+    df_phenotype_int_fastqtl = pd.DataFrame(
+        phenotype_int_values.T,
+        index=pd.Index(df_phenotype.columns, name='feature_id'),
+        columns=df_phenotype.index
+    )
     
     print(f"Saving INT Phenotype Matrix ({df_phenotype_int_fastqtl.shape}) to: {args.output_phenotype}")
-    df_phenotype_int_fastqtl.to_csv(args.output_phenotype, sep='\t', index=True)
+    write_matrix_tsv(df_phenotype_int_fastqtl, args.output_phenotype)
 
     # b. Covariate Matrix (Individuals are rows, Covariates are columns - FastQTL format)
     df_covariates_final.index.name = 'individual_id' # Set column name for FastQTL
     
     print(f"Saving Covariate Matrix ({df_covariates_final.shape}) to: {args.output_covariates}")
-    df_covariates_final.to_csv(args.output_covariates, sep='\t', index=True)
+    write_matrix_tsv(df_covariates_final, args.output_covariates)
+
+    # c. Optional Parquet copies (the TSVs remain the FastQTL inputs)
+    if args.write_parquet:
+        df_phenotype_int_fastqtl.to_parquet(parquet_output_path(args.output_phenotype), compression='zstd')
+        df_covariates_final.to_parquet(parquet_output_path(args.output_covariates), compression='zstd')
+        print("Saved Parquet copies of the phenotype and covariate matrices.")
 
     print("--- Phase 6 Normalization and Merge Complete ---")
 
@@ -122,6 +297,7 @@ if __name__ == "__main__":
     parser.add_argument("--input_peer_factors", required=True, help="Input file of PEER Factors.")
     parser.add_argument("--output_phenotype", required=True, help="Path to save the final INT-transformed phenotype matrix (FastQTL input).")
     parser.add_argument("--output_covariates", required=True, help="Path to save the final merged covariate matrix (FastQTL input).")
+    parser.add_argument("--write_parquet", action="store_true", help="Also write a zstd-compressed Parquet copy of each output table (same name, .parquet extension).")
     args = parser.parse_args()
     
     try:
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import os
+from contextlib import contextmanager
+import numpy as np
+import pyarrow as pa
+from pyarrow import csv as pacsv
+
+# Helpers shared by the pipeline scripts. Every script is launched as
+# python3 ./Python_scripts/<script>.py, so this module is importable as a sibling.
+
+# --- Output Paths ---
+def parquet_output_path(output_path):
+    """Path of the Parquet copy of a TSV output: the .tsv/.tsv.gz extension is replaced by .parquet."""
+    if output_path.endswith('.gz'):
+        output_path = output_path[:-len('.gz')]
+    return os.path.splitext(output_path)[0] + '.parquet'
+
+@contextmanager
+def atomic_output(path):
+    """
+    Yields a temporary path next to `path` and moves it into place once the block completes,
+    so an interrupted or concurrent run never reads a partial cache or output file. The
+    temporary file is removed if the block fails.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+# --- Matrix Writer ---
+def write_matrix_tsv(df, output_path, null_string='', comment_lines=()):
+    """
+    Writes a matrix as a tab-separated file (index as the first column) using the
+    multithreaded PyArrow CSV writer instead of DataFrame.to_csv.
+    An output path ending in '.gz' is gzip-compressed on the fly. Each entry of
+    comment_lines is written first as a '# ' header line.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    # from_pandas appends the index as the last column; move it to the front
+    names = table.column_names
+    table = table.select([names[-1]] + names[:-1])
+    write_options = pacsv.WriteOptions(delimiter='\t', quoting_style='none', quoting_header='none', null_string=null_string)
+    with pa.output_stream(output_path, compression='detect') as sink:
+        for line in comment_lines:
+            sink.write(f"# {line}\n".encode())
+        pacsv.write_csv(table, sink, write_options)
+
+# --- Multiple Testing ---
+def benjamini_hochberg(p_values):
+    """
+    Benjamini-Hochberg FDR-adjusted P-values (Q-values), equivalent to
+    multipletests(method='fdr_bh'): one argsort plus a reversed running minimum.
+    NaN P-values are excluded from the number of tests and stay NaN.
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    q_values = np.full(p_values.shape, np.nan)
+    observed = np.flatnonzero(~np.isnan(p_values))
+    n_tests = observed.size
+    if n_tests == 0:
+        return q_values
+    order = observed[np.argsort(p_values[observed], kind='mergesort')]
+    scaled = p_values[order] / (np.arange(1, n_tests + 1) / n_tests)
+    q_values[order] = np.minimum(np.minimum.accumulate(scaled[::-1])[::-1], 1.0)
+    return q_values
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 import pandas as pd
+import numpy as np
 import argparse
 import sys
-import os
+from functools import reduce
+from pipeline_common import parquet_output_path, write_matrix_tsv
 
 def prepare_aeiqtl_matrices(args):
     """
@@ -42,23 +44,40 @@ def prepare_aeiqtl_matrices(args):
         
     # 5. Merge Covariates (excluding the AEI covariate itself)
     # We use a subset of individuals common to the AEI phenotype and all covariates
-    individuals = df_phenotype_aeiqtl.columns.intersection(df_pcs.index).intersection(df_peer.index)
+    individuals = reduce(pd.Index.intersection, [df_phenotype_aeiqtl.columns, df_pcs.index, df_peer.index])
     
-    df_covariates_merged = pd.concat([df_pcs, df_peer], axis=1)
-    
-    # Finalize phenotype and covariates on the common set of individuals
+    # Finalize phenotype and covariates on the common set of individuals. Each covariate table's
+    # rows are copied into their slots of one preallocated zero buffer, so no outer-joined or
+    # NaN-filled intermediate matrix is materialized.
     df_phenotype_aeiqtl = df_phenotype_aeiqtl.loc[:, individuals]
-    df_covariates_aeiqtl = df_covariates_merged.loc[individuals].fillna(0)
+    covariate_columns = df_pcs.columns.append(df_peer.columns)
+    covariate_values = np.zeros((len(individuals), len(covariate_columns)))
+    col_start = 0
+    for df in [df_pcs, df_peer]:
+        row_idx = individuals.get_indexer(df.index)
+        present = row_idx >= 0
+        covariate_values[row_idx[present], col_start:col_start + df.shape[1]] = df.to_numpy(dtype=np.float64)[present]
+        col_start += df.shape[1]
+    covariate_values[np.isnan(covariate_values)] = 0
+    df_covariates_aeiqtl = pd.DataFrame(covariate_values, index=individuals, columns=covariate_columns)
     
     df_covariates_aeiqtl.index.name = 'individual_id'
-    df_covariates_aeiqtl = df_covariates_aeiqtl.loc[:, df_covariates_aeiqtl.nunique() > 1] # Remove non-variable
+    covariate_values = df_covariates_aeiqtl.to_numpy()
+    df_covariates_aeiqtl = df_covariates_aeiqtl.loc[:, covariate_values.max(axis=0, initial=-np.inf) > covariate_values.min(axis=0, initial=np.inf)] # Remove non-variable (max > min)
 
     # 6. Save Outputs
+    # Full precision through the PyArrow writer, as for the Phase 6 edQTL matrices
     print(f"Saving AEI-QTL Phenotype Matrix ({df_phenotype_aeiqtl.shape}) to: {args.output_phenotype}")
-    df_phenotype_aeiqtl.to_csv(args.output_phenotype, sep='\t', index=True)
+    write_matrix_tsv(df_phenotype_aeiqtl, args.output_phenotype)
 
     print(f"Saving AEI-QTL Covariate Matrix ({df_covariates_aeiqtl.shape}) to: {args.output_covariates}")
-    df_covariates_aeiqtl.to_csv(args.output_covariates, sep='\t', index=True)
+    write_matrix_tsv(df_covariates_aeiqtl, args.output_covariates)
+
+    # Optional Parquet copies (the TSVs remain the FastQTL inputs)
+    if args.write_parquet:
+        df_phenotype_aeiqtl.to_parquet(parquet_output_path(args.output_phenotype), compression='zstd')
+        df_covariates_aeiqtl.to_parquet(parquet_output_path(args.output_covariates), compression='zstd')
+        print("Saved Parquet copies of the AEI-QTL phenotype and covariate matrices.")
     
     print("--- AEI-QTL Matrix Preparation Complete ---")
 
@@ -69,5 +88,6 @@ if __name__ == "__main__":
     parser.add_argument("--input_peer_factors", required=True, help="Input file of PEER Factors.")
     parser.add_argument("--output_phenotype", required=True, help="Path to save the final AEI-QTL phenotype matrix (FastQTL input).")
     parser.add_argument("--output_covariates", required=True, help="Path to save the final AEI-QTL covariate matrix (FastQTL input).")
+    parser.add_argument("--write_parquet", action="store_true", help="Also write a zstd-compressed Parquet copy of each output table (same name, .parquet extension).")
     args = parser.parse_args()
     prepare_aeiqtl_matrices(args)
@@ -1,10 +1,38 @@
 #!/usr/bin/env python3
-import pandas as pd
 import numpy as np
 import argparse
-from statsmodels.sandbox.stats.multicomp import multipletests
 import sys
-import os
+import pyarrow as pa
+from pyarrow import csv as pacsv
+import re
+from pipeline_common import benjamini_hochberg, parquet_output_path
+
+def read_fastqtl_output(input_file, columns):
+    """
+    Reads the FastQTL columns in columns ({'f<index>': name}) into a DataFrame.
+    FastQTL output is single-space-separated and compressed (inferred from the extension).
+    The whole file is decompressed into memory (it has one row per feature) and scanned
+    once for irregular whitespace: a run of spaces or tabs would become empty fields under
+    a single-character delimiter and shift every later column. Only if some is found, the
+    buffer is rewritten with single spaces by two single-threaded re.sub passes. The buffer
+    is then parsed with the PyArrow CSV reader.
+    """
+    with pa.input_stream(input_file, compression='detect') as stream:
+        data = stream.read()
+    if re.search(rb'[ \t]{2,}|\t|^ | (?=\r?$)', data, flags=re.MULTILINE):
+        data = re.sub(rb'(?m)^[ \t]+|[ \t]+(?=\r?$)', b'', re.sub(rb'[ \t]+', b' ', data))
+    table = pacsv.read_csv(
+        pa.BufferReader(data),
+        read_options=pacsv.ReadOptions(autogenerate_column_names=True),
+        parse_options=pacsv.ParseOptions(delimiter=' '),
+        convert_options=pacsv.ConvertOptions(
+            null_values=['NA'],
+            strings_can_be_null=True,
+            column_types={'f0': pa.string(), 'f3': pa.string()},
+            include_columns=list(columns)
+        )
+    )
+    return table.rename_columns(list(columns.values())).to_pandas(self_destruct=True)
 
 # --- Main Function ---
 def process_fastqtl_results(args):
@@ -19,17 +47,6 @@ def process_fastqtl_results(args):
     print(f"--- Starting Phase 8: Processing FastQTL Results ---")
     print(f"Loading FastQTL results from: {args.input_file}")
     
-    # 1. Load Data
-    try:
-        # FastQTL output is space-separated, compressed
-        df_raw = pd.read_csv(args.input_file, sep='\s+', compression='infer', header=None)
-    except FileNotFoundError:
-        print(f"FATAL ERROR: Input file not found at {args.input_file}", file=sys.stderr)
-        sys.exit(1)
-    except Exception as e:
-        print(f"FATAL ERROR while loading file: {e}", file=sys.stderr)
-        sys.exit(1)
-
     # FastQTL Output Columns (assuming chunk 1 1 output):
     # 0: FeatureID
     # 1: n_snps
@@ -39,10 +56,20 @@ def process_fastqtl_results(args):
     # 5: nominal_P_value_beta (FastQTL-specific: used for P_perm calculation)
     # 6: P_permutation (empirical p-value, P_perm)
     # 7: P_beta (Best empirical p-value, P_beta)
+    # All eight columns are kept: the full table below is the archival copy of the FastQTL results
+    fastqtl_columns = {'f0': 'FeatureID', 'f1': 'n_snps', 'f2': 'P_nominal', 'f3': 'SNP_ID', 'f4': 'SNP_distance',
+                       'f5': 'nominal_P_value_beta', 'f6': 'P_permutation', 'f7': 'P_beta'}
     
-    # Use the column names that correspond to the permutation-based output
-    df_raw.columns = ['FeatureID', 'n_snps', 'P_nominal', 'SNP_ID', 'SNP_distance', 
-                      'nominal_P_value_beta', 'P_permutation', 'P_beta']
+    # 1. Load Data
+    try:
+        # Use the column names that correspond to the permutation-based output
+        df_raw = read_fastqtl_output(args.input_file, fastqtl_columns)
+    except FileNotFoundError:
+        print(f"FATAL ERROR: Input file not found at {args.input_file}", file=sys.stderr)
+        sys.exit(1)
+    except Exception as e:
+        print(f"FATAL ERROR while loading file: {e}", file=sys.stderr)
+        sys.exit(1)
     
     # Check for empty results
     if df_raw.empty:
@@ -56,26 +83,28 @@ def process_fastqtl_results(args):
     p_values = df_raw['P_beta'].values
     
     # Apply Benjamini-Hochberg procedure
-    reject, q_values, _, _ = multipletests(p_values, method='fdr_bh')
+    q_values = benjamini_hochberg(p_values)
+    
+    # Significance is read straight off the Q-values at the requested FDR threshold;
+    # the same mask is reused for the final filter below
+    significant_mask = q_values < FDR_THRESHOLD
     
     # Add Q-values and Significance status to the dataframe
     df_raw['Q_value'] = q_values
-    df_raw['Significant'] = reject
+    df_raw['Significant'] = significant_mask
     
-    print(f"Number of features passing FDR < {FDR_THRESHOLD} (Q-value): {np.sum(reject)}")
+    print(f"Number of features passing FDR < {FDR_THRESHOLD} (Q-value): {np.sum(significant_mask)}")
 
     # 3. Filtering and Final Output
-    df_final_edQTLs = df_raw[df_raw['Q_value'] < FDR_THRESHOLD].copy()
-
-    # Select and rename columns for clarity
-    df_final_edQTLs = df_final_edQTLs[['FeatureID', 'SNP_ID', 'P_nominal', 'P_beta', 'Q_value', 'SNP_distance']]
-    df_final_edQTLs.rename(columns={
+    # Select the significant rows and the output columns in one indexing step, then rename for clarity
+    output_cols = ['FeatureID', 'SNP_ID', 'P_nominal', 'P_beta', 'Q_value', 'SNP_distance']
+    df_final_edQTLs = df_raw.loc[significant_mask, output_cols].rename(columns={
         'SNP_ID': 'Lead_SNP_ID',
         'P_nominal': 'P_Nominal_Best',
         'P_beta': 'P_Empirical_Best',
         'Q_value': 'FDR_Q_value',
         'SNP_distance': 'Lead_SNP_Distance'
-    }, inplace=True)
+    })
     
     # Save the full table and the significant subset
     
@@ -88,6 +117,11 @@ def process_fastqtl_results(args):
     print(f"Saving {len(df_final_edQTLs)} significant edQTLs to: {args.output_file}")
     df_final_edQTLs.to_csv(args.output_file, sep='\t', index=False)
 
+    if args.write_parquet:
+        df_raw.to_parquet(parquet_output_path(full_output_file), compression='zstd', index=False)
+        df_final_edQTLs.to_parquet(parquet_output_path(args.output_file), compression='zstd', index=False)
+        print("Saved Parquet copies of the full and significant results.")
+
     print("--- Phase 8 Processing Complete ---")
 
 # --- Main Execution ---
@@ -96,6 +130,7 @@ if __name__ == "__main__":
     parser.add_argument("--input_file", required=True, help="Input FastQTL results file (e.g., from Phase 7).")
     parser.add_argument("--output_file", required=True, help="Path to save the final table of significant edQTLs (FDR < 0.05).")
     parser.add_argument("--fdr_threshold", type=float, default=0.05, help="FDR threshold for significance (Q-value).")
+    parser.add_argument("--write_parquet", action="store_true", help="Also write a zstd-compressed Parquet copy of each output table (same name, .parquet extension).")
     args = parser.parse_args()
     
     try:
@@ -1,43 +1,50 @@
 #!/usr/bin/env python3
 import pandas as pd
-import numpy as np
 import argparse
 import glob
 import os
 import sys
-from statsmodels.sandbox.stats.multicomp import multipletests
+from concurrent.futures import ThreadPoolExecutor
+from pipeline_common import benjamini_hochberg
+
+# --- Per-File Loader (runs in worker threads) ---
+def _load_fastqtl_file(file_path):
+    """
+    Loads the feature ID, variant ID and empirical P-value columns of one gzip'd FastQTL
+    result file, tagged with its source file name. Returns None if the file cannot be used.
+    """
+    # FastQTL output columns of interest:
+    # 1: gene_id (Feature ID), 2: variant_id (SNP ID), 12: p_beta (Empirical P-value)
+    if not os.path.exists(file_path):
+        print(f"WARNING: Input file not found: {file_path}. Skipping.", file=sys.stderr)
+        return None
+        
+    print(f"Loading and processing: {os.path.basename(file_path)}")
+    
+    try:
+        # Read only the necessary columns (0-based indexing)
+        df = pd.read_csv(file_path, sep='\t', compression='gzip', 
+                         usecols=[0, 1, 11], 
+                         names=['feature_id', 'variant_id', 'p_empirical'],
+                         skiprows=1) # Skip the header if present, or FastQTL summary line
+        
+        return df.assign(source_file=os.path.basename(file_path))
+    except Exception as e:
+        print(f"ERROR processing {file_path}: {e}", file=sys.stderr)
+        return None
 
 # --- Main Function ---
-def run_fdr_correction(input_files, output_dir):
+def run_fdr_correction(input_files, output_dir, threads=1, write_parquet=False):
     """
     Loads FastQTL results, performs FDR correction using the BH method 
     on the empirical p-values, and saves the final significant results.
     """
     
     # 1. Load Data
-    all_pvalues = []
-    
-    # FastQTL output columns of interest:
-    # 1: gene_id (Feature ID), 2: variant_id (SNP ID), 12: p_beta (Empirical P-value)
-    
-    for file_path in input_files:
-        if not os.path.exists(file_path):
-            print(f"WARNING: Input file not found: {file_path}. Skipping.", file=sys.stderr)
-            continue
-            
-        print(f"Loading and processing: {os.path.basename(file_path)}")
-        
-        try:
-            # Read only the necessary columns (0-based indexing)
-            df = pd.read_csv(file_path, sep='\t', compression='gzip', 
-                             usecols=[0, 1, 11], 
-                             names=['feature_id', 'variant_id', 'p_empirical'],
-                             skiprows=1) # Skip the header if present, or FastQTL summary line
-            
-            df['source_file'] = os.path.basename(file_path)
-            all_pvalues.append(df)
-        except Exception as e:
-            print(f"ERROR processing {file_path}: {e}", file=sys.stderr)
+    # The files are independent and dominated by I/O and gzip decompression, so they are
+    # read concurrently; map() keeps the input order, so the combined table is unchanged.
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        all_pvalues = [df for df in executor.map(_load_fastqtl_file, input_files) if df is not None]
 
     if not all_pvalues:
         print("FATAL ERROR: No valid data loaded for correction. Exiting.", file=sys.stderr)
@@ -58,9 +65,8 @@ def run_fdr_correction(input_files, output_dir):
     print(f"Applying BH FDR correction on {len(df_combined)} total tests...")
     
     # Use the Benjamini/Hochberg procedure to control False Discovery Rate (FDR)
-    reject, qvals, _, _ = multipletests(df_combined['p_empirical'], 
-                                        alpha=0.05, 
-                                        method='fdr_bh')
+    qvals = benjamini_hochberg(df_combined['p_empirical'].to_numpy())
+    reject = qvals <= 0.05
     
     df_combined['q_value'] = qvals
     df_combined['FDR_significant'] = reject
@@ -70,36 +76,49 @@ def run_fdr_correction(input_files, output_dir):
     df_significant = df_combined[df_combined['FDR_significant']]
     print(f"Total significant edQTLs/AEI-QTLs at q < 0.05: {len(df_significant)}")
     
-    # Group by Feature ID (editing site or AEI_CellType) and find the lead SNP (lowest P-value)
-    # The 'idxmin' on the empirical P-value will select the lead variant
-    idx = df_significant.groupby('feature_id')['p_empirical'].idxmin()
-    df_lead_snps = df_significant.loc[idx]
+    # For each Feature ID (editing site or AEI_CellType) find the lead SNP (lowest P-value)
+    # One stable sort on the empirical P-value puts each feature's lead variant first (ties keep
+    # file order, as idxmin did), and drop_duplicates keeps it - no grouped reduction or gather
+    if df_significant['feature_id'].is_unique:
+        # FastQTL --permute output already has one (best) test per feature: every row is its own lead SNP
+        df_lead_snps = df_significant
+    else:
+        df_lead_snps = df_significant.sort_values('p_empirical', kind='mergesort').drop_duplicates('feature_id', keep='first')
     
     print(f"Total unique lead edQTLs/AEI-QTLs identified: {len(df_lead_snps)}")
 
     # 4. Save Final Output
     final_output_path = os.path.join(output_dir, "master_edQTL_AEIQTL_lead_snps.tsv")
     print(f"Saving final lead SNPs to: {final_output_path}")
-    df_lead_snps.sort_values(by='q_value').to_csv(final_output_path, sep='\t', index=False)
+    df_lead_snps = df_lead_snps.sort_values(by='q_value')
+    df_lead_snps.to_csv(final_output_path, sep='\t', index=False)
     
     # Also save the full corrected table for later use
     full_output_path = os.path.join(output_dir, "master_edQTL_AEIQTL_full_corrected.tsv.gz")
-    df_combined.to_csv(full_output_path, sep='\t', index=False, compression='gzip')
+    # P/Q-values are written at full precision, like every other pipeline output
+    df_combined.to_csv(full_output_path, sep='\t', index=False, compression='gzip', chunksize=50000, lineterminator='\n')
     print("Full corrected results saved.")
 
+    if write_parquet:
+        df_lead_snps.to_parquet(os.path.join(output_dir, "master_edQTL_AEIQTL_lead_snps.parquet"), compression='zstd', index=False)
+        df_combined.to_parquet(os.path.join(output_dir, "master_edQTL_AEIQTL_full_corrected.parquet"), compression='zstd', index=False)
+        print("Saved Parquet copies of the lead SNP and full corrected tables.")
+
 # --- Main Execution ---
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Phase 8: FDR Correction and Lead SNP Identification.")
     parser.add_argument("--input_edqtl_results", required=True, nargs='+', help="List of FastQTL edQTL result files (e.g., chr*.txt.gz).")
     parser.add_argument("--input_aeiqtl_results", required=True, nargs='+', help="List of FastQTL AEI-QTL result files.")
     parser.add_argument("--output_dir", required=True, help="Directory to save the final corrected results.")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(), help="Number of threads used to read the FastQTL result files.")
+    parser.add_argument("--write_parquet", action="store_true", help="Also write a zstd-compressed Parquet copy of each output table (same name, .parquet extension).")
     args = parser.parse_args()
     
     # Combine the input lists for processing
     all_inputs = args.input_edqtl_results + args.input_aeiqtl_results
     
     try:
-        run_fdr_correction(all_inputs, args.output_dir)
+        run_fdr_correction(all_inputs, args.output_dir, args.threads, args.write_parquet)
     except Exception as e:
         print(f"\nFATAL UNCAUGHT ERROR in Phase 8: {e}", file=sys.stderr)
         sys.exit(1)
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 import pandas as pd
+import numpy as np
 import argparse
 import os
-import glob
 import sys
-import gzip
-import re
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.compute as pc
+from pipeline_common import atomic_output, parquet_output_path, write_matrix_tsv
 
 # --- 1. Argument Parsing and Setup ---
 parser = argparse.ArgumentParser(description="Phase 3: Individual Aggregation, Consensus Filtering, and Annotation.")
@@ -21,132 +26,189 @@ parser.add_argument("--rediportal_bed", required=True,
                     help="Path to the REDIPortal Known Sites BED file.")
 parser.add_argument("--ensembl_gtf", required=True,
                     help="Path to the Ensembl GTF file (e.g., Homo_sapiens.GRCh38.109.gtf.gz).")
+parser.add_argument("--threads", type=int, default=os.cpu_count(),
+                    help="Number of worker processes used to load the raw call files.")
+parser.add_argument("--write_parquet", action="store_true",
+                    help="Also write a zstd-compressed Parquet copy of the output matrix (same name, .parquet extension).")
 args = parser.parse_args()
 
 
 # --- 2. Annotation Helper Functions ---
 
-def parse_gtf_attributes(attribute_str: str) -> dict:
-    """Parses the attribute column of a GTF file."""
-    attributes = {}
-    matches = re.findall(r'\s*([^;]+?)\s+\"([^;]+?)\"\s*', attribute_str)
-    
-    for key, value in matches:
-        attributes[key.strip()] = value.strip()
-    return attributes
+GTF_COLUMNS = ['Chr', 'Source', 'FeatureType', 'Start', 'End', 'Score', 'Strand', 'Frame', 'Attributes']
+
+def _extract_gtf_attribute(attributes: pa.ChunkedArray, key: str) -> pa.ChunkedArray:
+    """Pulls one quoted attribute value out of a GTF attribute column (null where absent)."""
+    matches = pc.extract_regex(attributes, rf'(?:^|;)\s*{key}\s+"(?P<value>[^;]+?)"')
+    return pc.utf8_trim_whitespace(pc.struct_field(matches, 'value'))
 
 def load_gtf_features(gtf_path: str) -> pd.DataFrame:
     """Loads and preprocesses the GTF file to create a feature map."""
     print("  -> Loading and parsing Ensembl GTF file. This may take time...")
     
-    TARGET_FEATURES = {'exon', 'UTR', 'CDS'} 
+    TARGET_FEATURES = ['exon', 'UTR', 'CDS'] 
     FEATURE_TYPES = {'exon': 'Exon', 'CDS': 'CDS', 'five_prime_utr': 'UTR5', 'three_prime_utr': 'UTR3'}
 
-    gtf_records = []
-    opener = gzip.open if gtf_path.endswith('.gz') else open
-    
-    with opener(gtf_path, 'rt') as f:
-        for line in f:
-            if line.startswith('#'): continue
-            parts = line.strip().split('\t')
-            if len(parts) < 9: continue
-                
-            feature_type = parts[2]
-            
-            if feature_type in TARGET_FEATURES or feature_type.endswith('_utr'):
-                attributes = parse_gtf_attributes(parts[8])
-                gene_symbol = attributes.get('gene_name', attributes.get('gene_id', 'Unknown'))
-
-                gtf_records.append({
-                    'Chr': parts[0].replace('chr', ''), 
-                    'Start': int(parts[3]), 
-                    'End': int(parts[4]),    
-                    'Feature': FEATURE_TYPES.get(feature_type.lower(), feature_type),
-                    'Strand': parts[6],
-                    'Gene': gene_symbol
-                })
-
-    gtf_df = pd.DataFrame(gtf_records)
-    gtf_df['Chr'] = gtf_df['Chr'].astype(str).str.replace('^chr', '', regex=True)
+    # Bulk-read with pyarrow; '#' header lines have too few fields and are skipped as invalid rows
+    gtf_table = pacsv.read_csv(
+        gtf_path,
+        read_options=pacsv.ReadOptions(column_names=GTF_COLUMNS),
+        parse_options=pacsv.ParseOptions(delimiter='\t', quote_char=False, invalid_row_handler=lambda row: 'skip'),
+        convert_options=pacsv.ConvertOptions(
+            include_columns=['Chr', 'FeatureType', 'Start', 'End', 'Strand', 'Attributes'],
+            column_types={'Chr': pa.string(), 'FeatureType': pa.string(), 'Start': pa.int64(), 'End': pa.int64(),
+                          'Strand': pa.string(), 'Attributes': pa.string()},
+        ),
+    )
+
+    # Filter on the feature type first so the attribute regex only runs on the rows that are kept
+    feature_type = gtf_table['FeatureType']
+    keep = pc.and_(
+        pc.invert(pc.starts_with(gtf_table['Chr'], '#')),
+        pc.or_(pc.is_in(feature_type, value_set=pa.array(TARGET_FEATURES)), pc.ends_with(feature_type, '_utr')),
+    )
+    gtf_table = gtf_table.filter(keep)
+
+    attributes = gtf_table['Attributes']
+    gene_symbol = pc.coalesce(_extract_gtf_attribute(attributes, 'gene_name'), _extract_gtf_attribute(attributes, 'gene_id'), 'Unknown')
+    feature_type = gtf_table['FeatureType'].to_pandas()
+
+    gtf_df = pd.DataFrame({
+        'Chr': gtf_table['Chr'].to_pandas().str.replace('chr', '', regex=False),
+        'Start': gtf_table['Start'].to_numpy(),
+        'End': gtf_table['End'].to_numpy(),
+        'Feature': feature_type.str.lower().map(FEATURE_TYPES).fillna(feature_type),
+        'Strand': gtf_table['Strand'].to_pandas(),
+        'Gene': gene_symbol.to_pandas(),
+    })
     gtf_df.sort_values(by=['Chr', 'Start'], inplace=True)
+
+    # Compact dtypes: genomic coordinates fit in int32 and the string columns are highly repetitive
+    gtf_df = gtf_df.astype({'Start': np.int32, 'End': np.int32, 'Chr': 'category', 'Feature': 'category',
+                            'Strand': 'category', 'Gene': 'category'})
     
     print(f"  -> Loaded {len(gtf_df)} GTF features.")
     return gtf_df
 
-# Global variable for lazy loading
-GTF_FEATURE_MAP = None
+# Bump the version when the layout of the cached feature map changes
+GTF_CACHE_SUFFIX = '.featuremap.v1.parquet'
+
+@functools.lru_cache(maxsize=4)
 def get_gtf_feature_map(gtf_path: str) -> pd.DataFrame:
-    global GTF_FEATURE_MAP
-    if GTF_FEATURE_MAP is None:
-        GTF_FEATURE_MAP = load_gtf_features(gtf_path)
-    return GTF_FEATURE_MAP
+    """
+    Returns the GTF feature map (loaded once per path and process; callers must not modify it),
+    reusing a Parquet copy next to the GTF while it is newer than the GTF.
+    """
+    cache_path = gtf_path + GTF_CACHE_SUFFIX
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(gtf_path):
+        print(f"  -> Loading cached GTF feature map from {cache_path}")
+        return pd.read_parquet(cache_path, engine='pyarrow')
+
+    gtf_df = load_gtf_features(gtf_path)
+    try:
+        with atomic_output(cache_path) as tmp_path:
+            gtf_df.to_parquet(tmp_path, engine='pyarrow', compression='zstd')
+    except Exception as e:
+        print(f"  Warning: Could not write GTF feature map cache {cache_path}: {e}", file=sys.stderr)
+    return gtf_df
+
+# Bump the version when the layout of the cached REDIPortal keys changes
+REDIPORTAL_CACHE_SUFFIX = '.sitekeys.v1.npz'
+
+@functools.lru_cache(maxsize=4)
+def get_rediportal_keys(rediportal_bed_path: str):
+    """
+    Returns (chrom_vocab, known_keys): the REDIPortal chromosome names and the sorted, unique
+    int64 Chr:Pos keys (chromosome code << 32 | 1-based position). The arrays are stored next
+    to the BED and reused while they are newer than it, so each individual skips the BED parse.
+    """
+    cache_path = rediportal_bed_path + REDIPORTAL_CACHE_SUFFIX
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(rediportal_bed_path):
+        with np.load(cache_path, allow_pickle=False) as cached:
+            return pd.Index(cached['chroms']), cached['keys']
+
+    rediportal_sites = pd.read_csv(rediportal_bed_path, sep='\t', header=None, usecols=[0,1], compression='infer', dtype={0: str}, engine='pyarrow')
+    rediportal_sites.columns = ['Chr', 'Start']
+    chrom_vocab = pd.Index(pd.unique(rediportal_sites['Chr']))
+    # BED is 0-based; SiteIDs use 1-based positions
+    known_keys = np.unique((chrom_vocab.get_indexer(rediportal_sites['Chr']).astype(np.int64) << 32) | (rediportal_sites['Start'].to_numpy(np.int64) + 1))
+    try:
+        with atomic_output(cache_path) as tmp_path, open(tmp_path, 'wb') as fh:
+            np.savez(fh, chroms=chrom_vocab.to_numpy(dtype=str), keys=known_keys)
+    except Exception as e:
+        print(f"  Warning: Could not write REDIPortal key cache {cache_path}: {e}", file=sys.stderr)
+    return chrom_vocab, known_keys
 
 def annotate_rediportal_status(df: pd.DataFrame, rediportal_bed_path: str) -> pd.DataFrame:
     """Adds a 'REDIPortal_Status' column ('Known'/'Novel')."""
     df['REDIPortal_Status'] = 'Novel'
     try:
-        rediportal_sites = pd.read_csv(rediportal_bed_path, sep='\t', header=None, usecols=[0,1], compression='infer', dtype={0: str})
-        rediportal_sites.columns = ['Chr', 'Start']
-        rediportal_sites['Pos'] = rediportal_sites['Start'] + 1 
-        rediportal_sites['KnownID'] = rediportal_sites['Chr'].astype(str) + ':' + rediportal_sites['Pos'].astype(str)
-        known_site_ids = set(rediportal_sites['KnownID'])
-        
-        df.loc[df.index.to_series().apply(lambda x: x.split(':')[0] + ':' + x.split(':')[1]).isin(known_site_ids), 'REDIPortal_Status'] = 'Known'
+        chrom_vocab, known_keys = get_rediportal_keys(rediportal_bed_path)
+
+        # SiteID is Chr:Pos:Ref>Alt; the lookup key is Chr:Pos, encoded like the REDIPortal keys
+        parts = df.index.to_series().str.split(':', n=2, expand=True)
+        site_chrom_codes = chrom_vocab.get_indexer(parts[0]) # -1 for chromosomes absent from REDIPortal
+        site_keys = (site_chrom_codes.astype(np.int64) << 32) | parts[1].astype(np.int64).to_numpy()
+
+        # known_keys is sorted: binary-search each site instead of hashing
+        hit = np.searchsorted(known_keys, site_keys)
+        is_known = (site_chrom_codes >= 0) & (hit < len(known_keys))
+        is_known[is_known] = known_keys[hit[is_known]] == site_keys[is_known]
+        df['REDIPortal_Status'] = np.where(is_known, 'Known', 'Novel')
     except Exception as e:
         print(f"  Warning: Failed to load REDIPortal: {e}", file=sys.stderr)
     return df
 
+# Lower value wins when a site overlaps several features; anything else falls back behind Exon
+FEATURE_PRIORITY = {'CDS': 0, 'UTR3': 1, 'UTR5': 2, 'Exon': 3}
+
 def annotate_functional_region(df: pd.DataFrame, gtf_path: str) -> pd.DataFrame:
     """Annotates Functional_Region and Gene using GTF feature overlap."""
     print("  -> Annotating Functional Region and Gene using GTF...")
     gtf_df = get_gtf_feature_map(gtf_path)
     
-    site_positions = df.index.to_series().apply(lambda x: x.split(':')).apply(pd.Series).rename(columns={0: 'Chr', 1: 'Pos_str', 2: 'Ref_Alt'})
-    site_positions['Pos'] = site_positions['Pos_str'].astype(int)
-    site_positions.set_index(df.index, inplace=True)
+    parts = df.index.to_series().str.split(':', n=2, expand=True)
+    site_chr = parts[0].to_numpy(dtype=object)
+    site_pos = parts[1].astype(np.int64).to_numpy()
 
-    df['Functional_Region'] = 'Intergenic'
-    df['Gene'] = 'Intergenic'
+    functional_region = np.full(len(df), 'Intergenic', dtype=object)
+    gene = np.full(len(df), 'Intergenic', dtype=object)
+
+    for chrom, chrom_features in gtf_df.groupby('Chr', sort=False, observed=True):
+        site_idx = np.flatnonzero(site_chr == chrom)
+        if site_idx.size == 0: continue
+        pos = site_pos[site_idx]
+        starts = chrom_features['Start'].to_numpy()
+        ends = chrom_features['End'].to_numpy()
+
+        # Features are sorted by Start, so candidates for a site are [lo, hi):
+        # hi drops features starting after Pos, lo skips the prefix whose running max End is < Pos
+        hi = np.searchsorted(starts, pos, side='right')
+        lo = np.searchsorted(np.maximum.accumulate(ends), pos, side='left')
+        n_candidates = np.clip(hi - lo, 0, None)
+        total = int(n_candidates.sum())
+        if total == 0: continue
+
+        pair_site = np.repeat(np.arange(pos.size), n_candidates)
+        pair_feature = np.repeat(lo, n_candidates) + (np.arange(total) - np.repeat(np.cumsum(n_candidates) - n_candidates, n_candidates))
 
-    for site_id, row in site_positions.iterrows():
-        chrom = row['Chr']
-        pos = row['Pos']
-        
-        chrom_features = gtf_df[gtf_df['Chr'] == chrom]
-        
         # Check for overlap: Start <= Pos <= End
-        overlapping_features = chrom_features[
-            (chrom_features['Start'] <= pos) & 
-            (chrom_features['End'] >= pos)
-        ]
-        
-        if not overlapping_features.empty:
-            # Priority: CDS > UTR5/UTR3 > Exon
-            
-            cds_features = overlapping_features[overlapping_features['Feature'] == 'CDS']
-            if not cds_features.empty:
-                df.loc[site_id, 'Functional_Region'] = 'CDS'
-                df.loc[site_id, 'Gene'] = cds_features['Gene'].iloc[0]
-                continue
-            
-            utr_features = overlapping_features[overlapping_features['Feature'].isin(['UTR5', 'UTR3'])]
-            if not utr_features.empty:
-                best_feature = 'UTR3' if 'UTR3' in utr_features['Feature'].values else 'UTR5'
-                utr_row = utr_features[utr_features['Feature'] == best_feature].iloc[0]
-                df.loc[site_id, 'Functional_Region'] = best_feature
-                df.loc[site_id, 'Gene'] = utr_row['Gene']
-                continue
-            
-            exon_features = overlapping_features[overlapping_features['Feature'] == 'Exon']
-            if not exon_features.empty:
-                df.loc[site_id, 'Functional_Region'] = 'Exon'
-                df.loc[site_id, 'Gene'] = exon_features['Gene'].iloc[0]
-                continue
+        overlaps = ends[pair_feature] >= pos[pair_site]
+        pair_site, pair_feature = pair_site[overlaps], pair_feature[overlaps]
+        if pair_site.size == 0: continue
 
-            # Fallback for unexpected feature types
-            df.loc[site_id, 'Functional_Region'] = overlapping_features['Feature'].iloc[0]
-            df.loc[site_id, 'Gene'] = overlapping_features['Gene'].iloc[0]
+        # Priority: CDS > UTR3 > UTR5 > Exon > other, ties broken by GTF order; keep the first row per site
+        priority = chrom_features['Feature'].astype(object).map(FEATURE_PRIORITY).fillna(len(FEATURE_PRIORITY)).to_numpy()[pair_feature]
+        order = np.lexsort((pair_feature, priority, pair_site))
+        pair_site, pair_feature = pair_site[order], pair_feature[order]
+        first = np.r_[True, pair_site[1:] != pair_site[:-1]]
 
+        best_site, best_feature = site_idx[pair_site[first]], pair_feature[first]
+        functional_region[best_site] = chrom_features['Feature'].to_numpy(dtype=object)[best_feature]
+        gene[best_site] = chrom_features['Gene'].to_numpy(dtype=object)[best_feature]
+
+    df['Functional_Region'] = functional_region
+    df['Gene'] = gene
     return df
 
 
@@ -154,91 +216,150 @@ def annotate_functional_region(df: pd.DataFrame, gtf_path: str) -> pd.DataFrame:
 
 def explode_reditools_substitutions(df: pd.DataFrame) -> pd.DataFrame:
     """Explodes the REDItools 'AllSubs' column into multiple rows, standardizing columns."""
-    # (Same function as before, included for completeness)
-    sub_data = []
+    # Vectorized: split/explode in pandas instead of iterating rows and building dicts
     if df.empty: return pd.DataFrame()
+    df = df.rename(columns={'Reference': 'Ref', 'Frequency': 'EditLevel'})
+    df = df[df['AllSubs'].notna() & (df['AllSubs'] != '-')]
+
+    exploded = df[['Chr', 'Pos', 'Ref', 'EditLevel']].assign(Sub=df['AllSubs'].str.split(' ')).explode('Sub')
+    # Keep well-formed substitutions only (e.g., 'AG' style tokens are skipped, 'A>G' is kept)
+    subs = exploded['Sub']
+    exploded = exploded[(subs.str.len() == 3) & (subs.str[1] == '>')]
+    if exploded.empty: return pd.DataFrame()
+
+    exploded['Alt'] = exploded['Sub'].str[2]
+    return exploded[['Chr', 'Pos', 'Ref', 'Alt', 'EditLevel']].reset_index(drop=True)
+
+def _load_raw_call_file(f, individual_id, min_edit_level):
+    """
+    Loads and filters one raw call file (runs in a worker process) into an Arrow table.
+    A file whose calls are all dropped by the edit level / canonical filters still counts as
+    loaded and gives an empty table; None is returned only for a REDItools file with no
+    substitutions or a file that fails to load.
+    """
+    tool = 'REDML' if '_redml_raw.tsv' in f else 'REDItools'
+    
+    try:
+        if tool == 'REDML':
+            cols = ['Chr', 'Pos', 'Ref', 'Alt', 'VariantReads', 'TotalReads']
+            df = pd.read_csv(f, sep='\t', usecols=cols, dtype={'Chr': str, 'Pos': int}, engine='pyarrow')
+            # Zero-depth rows get NaN, which the edit level mask below drops
+            total_reads = df['TotalReads'].to_numpy(np.float64)
+            df['EditLevel'] = df['VariantReads'].to_numpy(np.float64) / np.where(total_reads > 0, total_reads, np.nan)
+        else: # REDItools
+            cols = ['Region', 'Position', 'Reference', 'AllSubs', 'Frequency']
+            df = pd.read_csv(f, sep='\t', usecols=cols, dtype={'Region': str, 'Position': int}, engine='pyarrow')
+            df.rename(columns={'Region': 'Chr', 'Position': 'Pos'}, inplace=True)
+            df = explode_reditools_substitutions(df.rename(columns={'Reference': 'Ref', 'Frequency': 'EditLevel'}))
+            if df.empty: return None
+        
+        # Edit level and canonical A>G / T>C filters in one mask, one copy
+        ref = df['Ref'].to_numpy()
+        alt = df['Alt'].to_numpy()
+        canonical = ((ref == 'A') & (alt == 'G')) | ((ref == 'T') & (alt == 'C'))
+        df = df[(df['EditLevel'] >= min_edit_level).to_numpy() & canonical].copy()
+        
+        df['Tool'] = tool
+        cell_type = os.path.basename(f).split(f'{individual_id}_')[1].split(f'_{tool.lower()}_raw.tsv')[0]
+        df['CellType'] = cell_type
+        # SiteID strings are built later, and only for consensus rows
+        df['Chr'] = df['Chr'].astype(str)
+        
+        # Hand back an Arrow table: cheap to pickle, and the parent concatenates without re-copying rows
+        return pa.Table.from_pandas(df.loc[:, ['Chr', 'Pos', 'Ref', 'Alt', 'CellType', 'Tool', 'EditLevel']], preserve_index=False)
         
-    for _, row in df.iterrows():
-        if pd.notna(row['AllSubs']) and row['AllSubs'] != '-':
-            substitutions = row['AllSubs'].split(' ')
-            for sub in substitutions:
-                if len(sub) == 3 and sub[1] == '>':
-                    sub_data.append({
-                        'Chr': row['Chr'],
-                        'Pos': row['Pos'],
-                        'Reference': row['Reference'],
-                        'Alt': sub[2],
-                        'EditLevel': row['Frequency']
-                    })
-    if not sub_data: return pd.DataFrame()
-    return pd.DataFrame(sub_data).rename(columns={'Reference': 'Ref'})
-
-def load_and_aggregate_raw_calls(root_search_dir, individual_id, min_edit_level):
+    except Exception as e:
+        print(f"Warning: Failed to process file {os.path.basename(f)}: {e}", file=sys.stderr)
+        return None
+
+def _iter_raw_call_files(directory, individual_id):
+    """Yields {individual_id}_*_raw.tsv paths below directory (recursive, hidden entries skipped)."""
+    prefix = f'{individual_id}_'
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'): continue
+            if entry.is_dir():
+                yield from _iter_raw_call_files(entry.path, individual_id)
+            elif entry.name.startswith(prefix) and entry.name.endswith('_raw.tsv'):
+                yield entry.path
+
+def load_and_aggregate_raw_calls(root_search_dir, individual_id, min_edit_level, threads=1):
     """Loads, filters, aggregates, and finds consensus for one individual."""
     
-    search_path = os.path.join(root_search_dir, individual_id, '**', f'{individual_id}_*_raw.tsv')
-    all_files = glob.glob(search_path, recursive=True)
+    # Only the individual's own subtree is walked
+    individual_dir = os.path.join(root_search_dir, individual_id)
+    all_files = sorted(_iter_raw_call_files(individual_dir, individual_id)) if os.path.isdir(individual_dir) else []
     
     if not all_files:
         raise FileNotFoundError(f"No raw call files found for individual {individual_id} in {root_search_dir}")
 
-    raw_df_list = []
-    
-    for f in all_files:
-        tool = 'REDML' if '_redml_raw.tsv' in f else 'REDItools'
-        
-        try:
-            if tool == 'REDML':
-                cols = ['Chr', 'Pos', 'Ref', 'Alt', 'VariantReads', 'TotalReads']
-                df = pd.read_csv(f, sep='\t', usecols=cols, dtype={'Chr': str, 'Pos': int})
-                df['EditLevel'] = df['VariantReads'] / df['TotalReads'].replace(0, pd.NA) 
-                df = df.dropna(subset=['EditLevel']) 
-            else: # REDItools
-                cols = ['Region', 'Position', 'Reference', 'AllSubs', 'Frequency']
-                df = pd.read_csv(f, sep='\t', usecols=cols, dtype={'Region': str, 'Position': int})
-                df.rename(columns={'Region': 'Chr', 'Position': 'Pos'}, inplace=True)
-                df = explode_reditools_substitutions(df.rename(columns={'Reference': 'Ref', 'Frequency': 'EditLevel'}))
-                if df.empty: continue
-            
-            df = df[df['EditLevel'] >= min_edit_level].copy()
-            df = df[((df['Ref'] == 'A') & (df['Alt'] == 'G')) | ((df['Ref'] == 'T') & (df['Alt'] == 'C'))].copy()
-            
-            df['Tool'] = tool
-            cell_type = os.path.basename(f).split(f'{individual_id}_')[1].split(f'_{tool.lower()}_raw.tsv')[0]
-            df['CellType'] = cell_type
-            df['SiteID'] = df['Chr'].astype(str) + ':' + df['Pos'].astype(str) + ':' + df['Ref'] + '>' + df['Alt']
+    # Files are independent: load them in parallel and concatenate once
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        loaded = executor.map(_load_raw_call_file, all_files, repeat(individual_id), repeat(min_edit_level))
+        raw_table_list = [table for table in loaded if table is not None]
             
-            raw_df_list.append(df.loc[:, ['SiteID', 'CellType', 'Tool', 'EditLevel']])
-            
-        except Exception as e:
-            print(f"Warning: Failed to process file {os.path.basename(f)}: {e}", file=sys.stderr)
-            
-    if not raw_df_list:
+    if not raw_table_list:
         raise ValueError(f"No valid data loaded after filtering for individual {individual_id}.")
 
-    return pd.concat(raw_df_list, ignore_index=True)
+    # Zero-copy chunk concat, then a single conversion to pandas
+    raw_df = pa.concat_tables(raw_table_list, promote_options='default').to_pandas()
+    # These columns take a handful of values; categoricals keep them as small integer codes
+    return raw_df.astype({'Chr': 'category', 'Ref': 'category', 'Alt': 'category', 'Tool': 'category', 'CellType': 'category'})
+
+def site_integer_keys(df: pd.DataFrame) -> np.ndarray:
+    """Packs Chr code, Pos and Ref>Alt code into one int64 per row; equal keys mean equal SiteIDs."""
+    ref_alt_code = df['Ref'].cat.codes.to_numpy(np.int64) * len(df['Alt'].cat.categories) + df['Alt'].cat.codes.to_numpy(np.int64)
+    return (df['Chr'].cat.codes.to_numpy(np.int64) << 40) | (df['Pos'].to_numpy(np.int64) << 8) | ref_alt_code
+
+def build_site_ids(df: pd.DataFrame) -> pd.Series:
+    """Materializes the Chr:Pos:Ref>Alt SiteID strings in one vectorized join."""
+    chrom, ref, alt = (pa.array(df[col].astype(str), type=pa.string()) for col in ['Chr', 'Ref', 'Alt'])
+    pos = pc.cast(pa.array(df['Pos'].to_numpy()), pa.string())
+    site_ids = pc.binary_join_element_wise(chrom, pos, pc.binary_join_element_wise(ref, alt, '>'), ':')
+    return site_ids.to_pandas().set_axis(df.index)
 
 
 def run_individual_processing(args):
-    """Runs the full aggregation, consensus filtering, and annotation pipeline."""
+    """
+    Runs the full aggregation, consensus filtering, and annotation pipeline.
+    Consensus sites are reported by both tools; where both give an edit level for the
+    same site and cell type, the REDItools value is the one written to the matrix.
+    """
 
-    raw_df = load_and_aggregate_raw_calls(args.root_search_dir, args.individual_id, args.min_edit_level)
+    raw_df = load_and_aggregate_raw_calls(args.root_search_dir, args.individual_id, args.min_edit_level, args.threads)
     print(f"Total raw entries loaded for {args.individual_id} after Edit Level >= {args.min_edit_level} filter: {len(raw_df)}")
 
     # 1. Consensus Filter (RED-ML intersect REDItools) - PER-INDIVIDUAL
-    consensus_check = raw_df.groupby('SiteID')['Tool'].nunique().reset_index(name='ToolCount')
-    consensus_sites = consensus_check[consensus_check['ToolCount'] == 2]['SiteID']
-    consensus_df = raw_df[raw_df['SiteID'].isin(consensus_sites)].copy()
+    # One bit per tool (REDML=1, REDItools=2) OR-reduced per site; consensus sites have both bits set
+    consensus_df = raw_df.iloc[:0]
+    if not raw_df.empty:
+        site_codes, _ = pd.factorize(site_integer_keys(raw_df))
+        tool_bits = np.where(raw_df['Tool'].to_numpy() == 'REDML', 1, 2).astype(np.uint8)
+        site_tool_mask = np.zeros(site_codes.max() + 1, dtype=np.uint8)
+        np.bitwise_or.at(site_tool_mask, site_codes, tool_bits)
+        consensus_df = raw_df[site_tool_mask[site_codes] == 3].copy()
     if consensus_df.empty:
         print("No consensus sites found for this individual. Skipping output.", file=sys.stderr)
         return
+    consensus_df['SiteID'] = build_site_ids(consensus_df)
         
     print(f"Unique consensus sites for {args.individual_id}: {consensus_df['SiteID'].nunique()}")
     
     
     # 2. Aggregate and Pivot (Site x CellType Matrix with RAW Edit Levels)
-    matrix_df = consensus_df.pivot(index='SiteID', columns='CellType', values='EditLevel')
-    matrix_df.fillna(0, inplace=True)
+    # Sites called by both tools appear twice per cell type; a stable sort puts REDItools rows first
+    # so the kept entry does not depend on file discovery order
+    tool_order = np.argsort(np.where(consensus_df['Tool'].to_numpy() == 'REDItools', 0, 1), kind='stable')
+    matrix_entries = consensus_df.iloc[tool_order].drop_duplicates(subset=['SiteID', 'CellType'], keep='first')
+    site_codes, site_labels = pd.factorize(matrix_entries['SiteID'], sort=True)
+    cell_type_codes, cell_type_labels = pd.factorize(matrix_entries['CellType'], sort=True)
+
+    # Scatter straight into a zero-filled buffer instead of pivoting to NaN and filling afterwards
+    matrix_values = np.zeros((len(site_labels), len(cell_type_labels)), dtype=np.float64)
+    matrix_values[site_codes, cell_type_codes] = matrix_entries['EditLevel'].to_numpy(dtype=np.float64)
+    matrix_df = pd.DataFrame(matrix_values,
+                             index=pd.Index(site_labels, name='SiteID'),
+                             columns=pd.Index(cell_type_labels, name='CellType'))
     
     
     # 3. Annotation
@@ -261,10 +382,15 @@ def run_individual_processing(args):
     print(f"Saving final annotated raw matrix to {args.output_file}")
     
     # Write to file
-    with open(args.output_file, 'w') as f:
-        f.write(f"# Processed Individual: {args.individual_id}\n")
-        f.write("# --- SITE-LEVEL QUANTIFICATION (Raw Edit Levels) ---\n")
-        final_output_df.to_csv(f, sep='\t', index=True)
+    write_matrix_tsv(final_output_df, args.output_file,
+                     comment_lines=[f"Processed Individual: {args.individual_id}",
+                                    "--- SITE-LEVEL QUANTIFICATION (Raw Edit Levels) ---"])
+
+    # Optional Parquet copy (the TSV remains the Phase 4 input); annotation columns are dictionary-encoded
+    if args.write_parquet:
+        final_output_df.astype({col: 'category' for col in annotation_cols}).to_parquet(
+            parquet_output_path(args.output_file), engine='pyarrow', compression='zstd')
+        print("Saved Parquet copy of the annotated matrix.")
 
 
 # --- 4. Main Execution ---
@@ -9,6 +9,9 @@ from collections import defaultdict
 import re
 import gzip
 import numpy as np
+from multiprocessing import Pool
+from numba import njit
+from pipeline_common import atomic_output
 
 # --- 1. Configuration and Setup ---
 parser = argparse.ArgumentParser(description="Phase 4 (Reworked) v3: Per-Cell Quantification using Phase 3 Matrix with optional annotation filtering.")
@@ -21,7 +24,7 @@ parser.add_argument("--individual_id", required=True, help="Individual ID for VC
 parser.add_argument("--gtf_annotation", required=True, help="Path to the Ensembl GTF file.")
 parser.add_argument("--splice_site_threshold", type=int, default=4, help="Exclude sites within this many bp of a splice junction.")
 parser.add_argument("--min_read_coverage", type=int, default=10, help="Minimum TotalReads required at a site.")
-parser.add_argument("--threads", type=int, default=16, help="Number of threads for parallel processing (optional).")
+parser.add_argument("--threads", type=int, default=16, help="Number of worker processes used for the per-BAM quantification.")
 # NEW OPTIONAL FILTER ARGUMENTS
 parser.add_argument("--filter_redip_status", type=str, default=None, help="Filter Phase 3 sites by a specific REDIPortal_Status (e.g., 'Known'). Set to None to disable.")
 parser.add_argument("--filter_func_region", type=str, default=None, help="Filter Phase 3 sites by a specific Functional_Region (e.g., 'UTR3'). Set to None to disable.")
@@ -38,7 +41,7 @@ if not BAM_FILES:
 GTF_JUNCTION_MAP = None 
 
 # --- Helper functions (parse_gtf_attributes, load_gtf_splice_junctions, 
-# --- parse_gtf_and_get_annotation, check_germline_status, quantify_site_per_bam) 
+# --- splice_junction_distances, germline_status_batch, quantify_sites_per_bam) 
 # --- remain structurally the same as v2 but are included here for completeness.
 
 def parse_gtf_attributes(attribute_str: str) -> dict:
@@ -49,8 +52,21 @@ def parse_gtf_attributes(attribute_str: str) -> dict:
         attributes[key.strip()] = value.strip()
     return attributes
 
+JUNCTION_CACHE_SUFFIX = '.splicejunctions.v1.npz'
+
 def load_gtf_splice_junctions(gtf_path: str) -> dict:
-    """Loads all known splice junction coordinates (exon ends/starts) from GTF."""
+    """
+    Loads all known splice junction coordinates (exon ends/starts) from GTF. The per-chromosome
+    arrays are stored next to the GTF and reused while they are newer than it, so repeated runs
+    skip the GTF parse.
+    """
+    cache_path = gtf_path + JUNCTION_CACHE_SUFFIX
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(gtf_path):
+        print(f"Loading cached GTF splice junction coordinates from {cache_path}...")
+        with np.load(cache_path, allow_pickle=False) as cached:
+            chroms, offsets, positions = cached['chroms'], cached['offsets'], cached['positions']
+        return {chrom: positions[offsets[i]:offsets[i + 1]] for i, chrom in enumerate(chroms.tolist())}
+
     print("Loading GTF splice junction coordinates...")
     junctions = defaultdict(list)
     opener = gzip.open if gtf_path.endswith('.gz') else open
@@ -67,99 +83,168 @@ def load_gtf_splice_junctions(gtf_path: str) -> dict:
                 junctions[chrom].append(start)
                 junctions[chrom].append(end) 
 
-    for chrom in junctions:
-        junctions[chrom] = sorted(list(set(junctions[chrom])))
+    # Sorted, unique int64 arrays so lookups can binary-search
+    junctions = {chrom: np.unique(np.array(coords, dtype=np.int64)) for chrom, coords in junctions.items()}
+    try:
+        # Chromosomes are stored as one concatenated array plus offsets
+        offsets = np.cumsum([0] + [len(coords) for coords in junctions.values()], dtype=np.int64)
+        positions = np.concatenate(list(junctions.values())) if junctions else np.empty(0, dtype=np.int64)
+        with atomic_output(cache_path) as tmp_path, open(tmp_path, 'wb') as fh:
+            np.savez(fh, chroms=np.array(list(junctions), dtype=str), offsets=offsets, positions=positions)
+    except Exception as e:
+        print(f"Warning: Could not write splice junction cache {cache_path}: {e}", file=sys.stderr)
     return junctions
 
-def parse_gtf_and_get_annotation(gtf_file, chrom, pos, splice_threshold):
-    """Checks for proximity to splice sites and returns global filter status and annotation."""
+def splice_junction_distances(gtf_file, chroms, positions):
+    """
+    Distance from every site to its nearest known splice junction, computed per chromosome with
+    one vectorized searchsorted. Sites on chromosomes without junctions (or when the GTF cannot
+    be loaded) get 9999.
+    """
     global GTF_JUNCTION_MAP
+    min_dist = np.full(len(positions), 9999, dtype=np.int64)
     if GTF_JUNCTION_MAP is None:
         try:
             GTF_JUNCTION_MAP = load_gtf_splice_junctions(gtf_file)
         except Exception as e:
             print(f"CRITICAL: Failed to load GTF for SJ filtering: {e}", file=sys.stderr)
-            return {'GlobalFilterStatus': 'GTF_Error', 'MinDistToSplice': 9999} 
+            return min_dist
 
-    chrom = chrom.replace('chr', '')
-    min_dist = 9999
-    if chrom in GTF_JUNCTION_MAP:
-        junctions = np.array(GTF_JUNCTION_MAP[chrom])
-        min_dist = np.min(np.abs(junctions - pos))
-        
-        if min_dist <= splice_threshold:
-            return {
-                'GlobalFilterStatus': f"SJ_Filtered_<{splice_threshold}bp", 
-                'MinDistToSplice': int(min_dist)
-            }
-            
-    return {
-        'GlobalFilterStatus': 'PASS', 
-        'MinDistToSplice': int(min_dist), 
-        'FunctionalRegion': 'N/A', 
-        'gene_name': 'N/A', 
-        'transcript_id': 'N/A', 
-        'gene_biotype': 'N/A'
-    }
+    chroms = pd.Series(chroms).str.replace('chr', '', regex=False).to_numpy()
+    for chrom in pd.unique(chroms):
+        junctions = GTF_JUNCTION_MAP.get(chrom)
+        if junctions is None: continue
+        on_chrom = chroms == chrom
+        pos = positions[on_chrom]
+        # Only the junctions either side of the insertion point can be the nearest one
+        idx = np.searchsorted(junctions, pos)
+        left = pos - junctions[np.clip(idx - 1, 0, len(junctions) - 1)]
+        right = junctions[np.clip(idx, 0, len(junctions) - 1)] - pos
+        min_dist[on_chrom] = np.minimum(np.abs(left), np.abs(right))
+    return min_dist
+
+def germline_status_batch(sites, vcf_path, ind_id):
+    """
+    Uses Pysam to query VCF for germline SNP status of many (chrom, pos, ref, alt) sites.
+    The VCF is opened once and fetched once per chromosome over the span of that chromosome's
+    sites; records are matched to sites by position. Returns (is_germline_snp, vcf_status) per site.
+    """
+    statuses = [(False, "SomaticEdit")] * len(sites)
+
+    sites_by_chrom = defaultdict(dict)
+    for i, (chrom, pos, ref, alt) in enumerate(sites):
+        sites_by_chrom[chrom].setdefault(pos, []).append(i)
 
-def check_germline_status(chrom, pos, ref, alt, vcf_path, ind_id):
-    """Uses Pysam to query VCF for germline SNP status."""
-    is_germline_snp = False
-    vcf_status = "SomaticEdit"
-    
     try:
         vcf_in = pysam.VariantFile(vcf_path)
-        for rec in vcf_in.fetch(chrom, pos - 1, pos):
-            if rec.ref == ref and alt in rec.alts:
-                sample = rec.samples[ind_id]
-                if sample["GT"] in [(0, 1), (1, 1), (1, 0)]: 
-                    is_germline_snp = True
-                    vcf_status = "GermlineSNP"
-                    break
-        vcf_in.close()
-
     except Exception as e:
-        vcf_status = f"VCF_Error: {e}"
-        print(f"Warning: Failed VCF query at {chrom}:{pos}: {e}", file=sys.stderr)
+        print(f"Warning: Failed to open VCF {vcf_path}: {e}", file=sys.stderr)
+        return [(False, f"VCF_Error: {e}")] * len(sites)
 
-    return is_germline_snp, vcf_status
+    with vcf_in:
+        for chrom, sites_at_pos in sites_by_chrom.items():
+            try:
+                for rec in vcf_in.fetch(chrom, min(sites_at_pos) - 1, max(sites_at_pos)):
+                    for i in sites_at_pos.get(rec.pos, ()):
+                        _, _, ref, alt = sites[i]
+                        if rec.ref == ref and rec.alts and alt in rec.alts:
+                            sample = rec.samples[ind_id]
+                            if sample["GT"] in [(0, 1), (1, 1), (1, 0)]: 
+                                statuses[i] = (True, "GermlineSNP")
 
-def quantify_site_per_bam(chrom, pos, ref, alt, bam_path, min_coverage):
-    """Pysam pileup and count bases, applying the MIN_COVERAGE mask."""
-    total_reads = 0
-    variant_reads = 0
-    
+            except Exception as e:
+                print(f"Warning: Failed VCF query on {chrom}: {e}", file=sys.stderr)
+                for site_indices in sites_at_pos.values():
+                    for i in site_indices:
+                        if not statuses[i][0]:
+                            statuses[i] = (False, f"VCF_Error: {e}")
+
+    return statuses
+
+# Sites closer than this are counted with one count_coverage call
+COVERAGE_WINDOW = 10_000
+BASE_INDEX = {'A': 0, 'C': 1, 'G': 2, 'T': 3} # row order of count_coverage output
+
+# Sites per block when writing the final matrix
+MATRIX_WRITE_BLOCK = 50_000
+
+# Per-site QC labels, indexed by the status codes the tally kernel emits
+QC_LABELS = np.array(['PASS', 'LowCoverage', 'BAM_Error'], dtype=object)
+QC_PASS, QC_LOW_COVERAGE, QC_BAM_ERROR = 0, 1, 2
+
+@njit(cache=True)
+def _tally_sites(base_counts, alt_idx, min_coverage):
+    """
+    Turns a (4 x Sites) A/C/G/T count array into TotalReads, EditingRatio and a QC status code per
+    site, applying the MIN_COVERAGE mask (EditingRatio is NaN below it). alt_idx is the count_coverage
+    row of each site's Alt base, or -1 for a non-ACGT Alt, which counts no variant reads.
+    """
+    n_sites = base_counts.shape[1]
+    total_reads = np.empty(n_sites, dtype=np.int64)
+    editing_ratio = np.full(n_sites, np.nan)
+    status = np.empty(n_sites, dtype=np.uint8)
+    for i in range(n_sites):
+        total = base_counts[0, i] + base_counts[1, i] + base_counts[2, i] + base_counts[3, i]
+        total_reads[i] = total
+        if total < min_coverage or total == 0:
+            status[i] = QC_LOW_COVERAGE
+            continue
+        variant = base_counts[alt_idx[i], i] if alt_idx[i] >= 0 else 0
+        editing_ratio[i] = variant / total
+        status[i] = QC_PASS
+    return total_reads, editing_ratio, status
+
+def quantify_sites_per_bam(sites, bam_file, min_coverage):
+    """
+    Counts bases at each (chrom, pos, ref, alt) site on an open BAM handle and applies the
+    MIN_COVERAGE mask. Sites are sorted and grouped into windows of at most COVERAGE_WINDOW bp;
+    each window is counted in C with one count_coverage call (A/C/G/T arrays, no base-quality
+    cut) instead of a per-read pileup loop in Python. TotalReads is the A+C+G+T depth at the site.
+    Returns (total_reads, editing_ratio, status_codes) arrays in the order of `sites`.
+    """
+    base_counts = np.zeros((4, len(sites)), dtype=np.int64)
+    failed = np.zeros(len(sites), dtype=bool)
+    order = sorted(range(len(sites)), key=lambda i: (sites[i][0], sites[i][1]))
+
+    k = 0
+    while k < len(order):
+        chrom, first_pos = sites[order[k]][0], sites[order[k]][1]
+        j = k
+        while j + 1 < len(order) and sites[order[j + 1]][0] == chrom and sites[order[j + 1]][1] - first_pos < COVERAGE_WINDOW:
+            j += 1
+        window = order[k:j + 1]
+        w_start, w_end = first_pos - 1, sites[order[j]][1]
+
+        try:
+            counts = np.asarray(bam_file.count_coverage(chrom, w_start, w_end, quality_threshold=0), dtype=np.int64)
+            offsets = np.array([sites[i][1] - 1 - w_start for i in window])
+            base_counts[:, window] = counts[:, offsets]
+
+        except Exception as e:
+            print(f"Error querying BAM {os.path.basename(os.fsdecode(bam_file.filename))} at {chrom}:{w_start + 1}-{w_end}: {e}", file=sys.stderr)
+            failed[window] = True
+        k = j + 1
+
+    alt_idx = np.array([BASE_INDEX.get(site[3], -1) for site in sites], dtype=np.int64)
+    total_reads, editing_ratio, status = _tally_sites(base_counts, alt_idx, min_coverage)
+    total_reads[failed] = 0
+    editing_ratio[failed] = np.nan
+    status[failed] = QC_BAM_ERROR
+    return total_reads, editing_ratio, status
+
+
+def _quantify_sites_in_bam(task):
+    """Quantifies a chunk of sites against one BAM (runs in a worker process), opening the BAM once."""
+    bam_path, start, sites, min_coverage = task
     try:
         bam_file = pysam.AlignmentFile(bam_path, "rb")
-        for pileupcolumn in bam_file.pileup(chrom, pos - 1, pos, truncate=True, max_depth=100000):
-            if pileupcolumn.pos == pos - 1:
-                total_reads = pileupcolumn.n
-                for pileupread in pileupcolumn.pileups:
-                    if not pileupread.is_del and not pileupread.is_refskip and pileupread.query_position is not None:
-                        base = pileupread.alignment.query_sequence[pileupread.query_position]
-                        if base == alt:
-                            variant_reads += 1
-                break
-        bam_file.close()
-
     except Exception as e:
-        print(f"Error querying BAM {os.path.basename(bam_path)} at {chrom}:{pos}: {e}", file=sys.stderr)
-        return {'TotalReads': 0, 'VariantReads': 0, 'EditingRatio': 'NA'}, "BAM_Error"
-
-    if total_reads < min_coverage:
-        return {
-            'TotalReads': total_reads, 
-            'VariantReads': variant_reads,
-            'EditingRatio': 'NA' 
-        }, "LowCoverage"
-        
-    editing_ratio = variant_reads / total_reads
-    
-    return {
-        'TotalReads': total_reads, 
-        'VariantReads': variant_reads,
-        'EditingRatio': editing_ratio
-    }, "PASS"
+        print(f"Error opening BAM {os.path.basename(bam_path)}: {e}", file=sys.stderr)
+        return bam_path, start, (np.zeros(len(sites), dtype=np.int64), np.full(len(sites), np.nan), np.full(len(sites), QC_BAM_ERROR, dtype=np.uint8))
+
+    with bam_file:
+        results = quantify_sites_per_bam(sites, bam_file, min_coverage)
+    return bam_path, start, results
 
 
 # --- 3. Main Execution and Matrix Construction ---
@@ -200,79 +285,87 @@ def run_phase4_quantification(args):
     phase3_df[['Chr', 'Pos', 'Ref', 'Alt']] = site_components[['Chr', 'Pos', 'Ref', 'Alt']]
 
     print("Applying global VCF and Splice Junction filters...")
-    site_annotation = {}
-    
-    for site_id, site in phase3_df.iterrows():
-        chrom, pos, ref, alt = site.Chr, site.Pos, site.Ref, site.Alt
-        
-        # 1. Germline SNP Filter
-        is_snp, vcf_status = check_germline_status(chrom, pos, ref, alt, args.germline_vcf, args.individual_id)
-        
-        # 2. Splice Junction Filter
-        gtf_annot = parse_gtf_and_get_annotation(args.gtf_annotation, chrom, pos, args.splice_site_threshold)
-        
-        # Determine final Global Status
-        if is_snp:
-            global_status = vcf_status 
-        elif gtf_annot['GlobalFilterStatus'].startswith('SJ_Filtered'):
-            global_status = gtf_annot['GlobalFilterStatus']
-        else:
-            global_status = "PASS"
-            
-        site_annotation[site_id] = {
-            'GlobalFilterStatus': global_status,
-            'VCF_Status': vcf_status,
-            'MinDistToSplice': gtf_annot.get('MinDistToSplice', 9999),
-            # Keep original annotation carried from Phase 3
-            'Phase3_FunctionalRegion': site.Functional_Region, 
-            'Phase3_Gene': site.Gene,
-            'Phase3_REDIPortal_Status': site.REDIPortal_Status
-        }
+
+    # Splice Junction Filter, vectorized over all sites
+    min_dist_to_splice = splice_junction_distances(args.gtf_annotation, phase3_df['Chr'], phase3_df['Pos'].to_numpy(np.int64))
+    sj_status = np.where(min_dist_to_splice <= args.splice_site_threshold, f"SJ_Filtered_<{args.splice_site_threshold}bp", "PASS")
+
+    # Germline SNP Filter, one VCF sweep per chromosome
+    all_sites = list(zip(phase3_df['Chr'], phase3_df['Pos'].astype(int).tolist(), phase3_df['Ref'], phase3_df['Alt']))
+    germline_statuses = germline_status_batch(all_sites, args.germline_vcf, args.individual_id)
+
+    is_snp = np.array([status[0] for status in germline_statuses], dtype=bool)
+    vcf_status = np.array([status[1] for status in germline_statuses], dtype=object)
+
+    # One row per site; germline SNP takes precedence over the splice-junction filter
+    site_annotation = pd.DataFrame({
+        'GlobalFilterStatus': np.where(is_snp, vcf_status, sj_status.astype(object)),
+        'VCF_Status': vcf_status,
+        'MinDistToSplice': min_dist_to_splice.astype(np.int64),
+        # Keep original annotation carried from Phase 3
+        'Phase3_FunctionalRegion': phase3_df['Functional_Region'].to_numpy(),
+        'Phase3_Gene': phase3_df['Gene'].to_numpy(),
+        'Phase3_REDIPortal_Status': phase3_df['REDIPortal_Status'].to_numpy(),
+    }, index=phase3_df.index)
         
     # --- STEP 3: Per-Cell Quantification and Matrix Building ---
     
     standard_cols = ['SiteID', 'Chr', 'Pos', 'Ref', 'Alt', 'GlobalFilterStatus', 
                      'VCF_Status', 'MinDistToSplice', 'Phase3_FunctionalRegion', 'Phase3_Gene', 'Phase3_REDIPortal_Status']
     
-    matrix_rows = [] 
-    
     print("Starting per-cell-type quantification on globally PASS sites...")
 
-    for site_id, annot in site_annotation.items():
-        # Only process sites that passed global VCF and SJ filters
-        if annot['GlobalFilterStatus'] != 'PASS':
-            continue
+    # Only process sites that passed global VCF and SJ filters
+    is_passing = (site_annotation['GlobalFilterStatus'] == 'PASS').to_numpy()
+    passing_annotation = site_annotation[is_passing]
+    passing_df = phase3_df[is_passing]
+    passing_sites = list(zip(passing_df['Chr'], passing_df['Pos'].astype(int).tolist(), passing_df['Ref'], passing_df['Alt']))
+    n_sites = len(passing_sites)
 
-        site_row = phase3_df.loc[site_id]
-        chrom, pos, ref, alt = site_row.Chr, site_row.Pos, site_row.Ref, site_row.Alt
+    # (site chunk x BAM) pairs are independent: spread them over the worker pool
+    chunk_size = max(1, -(-n_sites // args.threads))
+    tasks = [(bam_path, start, passing_sites[start:start + chunk_size], args.min_read_coverage)
+             for bam_path in BAM_FILES for start in range(0, n_sites, chunk_size)]
+    # Each chunk's result arrays are copied into the per-BAM columns as they arrive
+    editing_ratio = {bam_path: np.full(n_sites, np.nan) for bam_path in BAM_FILES}
+    total_reads = {bam_path: np.zeros(n_sites, dtype=np.int64) for bam_path in BAM_FILES}
+    qc_status = {bam_path: np.empty(n_sites, dtype=object) for bam_path in BAM_FILES}
+    with Pool(args.threads) as pool:
+        for bam_path, start, (chunk_reads, chunk_ratio, chunk_status) in pool.imap_unordered(_quantify_sites_in_bam, tasks):
+            chunk = slice(start, start + len(chunk_status))
+            total_reads[bam_path][chunk] = chunk_reads
+            editing_ratio[bam_path][chunk] = chunk_ratio
+            qc_status[bam_path][chunk] = QC_LABELS[chunk_status]
+
+    cell_type_ids = {bam_path: os.path.basename(bam_path).replace('.bam', '').split('_')[-1] for bam_path in BAM_FILES}
+
+    matrix_cols = {
+        'SiteID': passing_df.index,
+        'Chr': np.array([site[0] for site in passing_sites], dtype=object),
+        'Pos': np.array([site[1] for site in passing_sites], dtype=np.int64),
+        'Ref': np.array([site[2] for site in passing_sites], dtype=object),
+        'Alt': np.array([site[3] for site in passing_sites], dtype=object),
+    }
+    for col in standard_cols[5:]:
+        matrix_cols[col] = passing_annotation[col].to_numpy()
+
+    for bam_path in BAM_FILES:
+        cell_type_id = cell_type_ids[bam_path]
+        matrix_cols[f'{cell_type_id}_ER'] = editing_ratio[bam_path]
+        matrix_cols[f'{cell_type_id}_TR'] = total_reads[bam_path]
+        matrix_cols[f'{cell_type_id}_QC'] = qc_status[bam_path]
 
-        row = {'SiteID': site_id, 'Chr': chrom, 'Pos': pos, 'Ref': ref, 'Alt': alt}
-        row.update(annot)
-        
-        # Quantification
-        for bam_path in BAM_FILES:
-            bam_id = os.path.basename(bam_path).replace('.bam', '')
-            cell_type_id = bam_id.split('_')[-1] 
-            
-            metrics, status = quantify_site_per_bam(chrom, pos, ref, alt, bam_path, args.min_read_coverage)
-            
-            row[f'{cell_type_id}_ER'] = metrics['EditingRatio'] 
-            row[f'{cell_type_id}_TR'] = metrics['TotalReads'] 
-            row[f'{cell_type_id}_QC'] = status                 
-
-        matrix_rows.append(row)
-
-    # Convert the list of rows to the final DataFrame
-    final_df = pd.DataFrame(matrix_rows)
-    
     # Final cleanup and output
-    final_cols = standard_cols + sorted([col for col in final_df.columns if col not in standard_cols])
-    
-    final_df = final_df[[col for col in final_cols if col in final_df.columns]]
-    final_df.set_index('SiteID', inplace=True) # Set SiteID as the index
+    final_cols = standard_cols + sorted([col for col in matrix_cols if col not in standard_cols])
+
+    # Written in blocks of sites so the full matrix is never copied into one DataFrame
+    with open(args.output_file, 'w') as out:
+        for block_start in range(0, max(n_sites, 1), MATRIX_WRITE_BLOCK):
+            block = slice(block_start, block_start + MATRIX_WRITE_BLOCK)
+            block_df = pd.DataFrame({col: matrix_cols[col][block] for col in final_cols}).set_index('SiteID')
+            block_df.to_csv(out, sep='\t', index=True, header=(block_start == 0), na_rep='NA')
 
-    final_df.to_csv(args.output_file, sep='\t', index=True, na_rep='NA')
-    print(f"\nPhase 4 quantification complete. Final matrix size: {len(final_df)} rows.")
+    print(f"\nPhase 4 quantification complete. Final matrix size: {n_sites} rows.")
 
 
 # --- 4. Main Execution ---
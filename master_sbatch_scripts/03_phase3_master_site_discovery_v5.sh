@@ -38,6 +38,7 @@ FINAL_OUTPUT_FILE="${INDIVIDUAL_OUTPUT_DIR}/${INDIVIDUAL_ID}_annotated_raw_matri
 
 # --- Parameters ---
 MIN_EDIT_LEVEL=0.1 
+THREADS=${SLURM_CPUS_PER_TASK:-1}
 
 # Input validation
 if [[ -z "$INDIVIDUAL_ID" ]]; then
@@ -59,7 +60,8 @@ python3 ${PROCESSING_PYTHON_SCRIPT} \
     --output_file "${FINAL_OUTPUT_FILE}" \
     --min_edit_level ${MIN_EDIT_LEVEL} \
     --rediportal_bed "${REDIPortal_BED}" \
-    --ensembl_gtf "${ENSEMBL_GTF}"
+    --ensembl_gtf "${ENSEMBL_GTF}" \
+    --threads ${THREADS}
 
 if [ $? -ne 0 ]; then
     echo "ERROR: Phase 3 Individual Annotation failed."
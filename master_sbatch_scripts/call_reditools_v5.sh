@@ -87,41 +87,61 @@ AEI_CALLS_FILE="${AEI_OUTPUT_SUBDIR}/${INDIVIDUAL_ID}_${CELL_TYPE_NAME}_ALU_ONLY
 echo "--- Starting Dual REDItools3 Call for ${CELL_TYPE_NAME} (${INDIVIDUAL_ID}) ---"
 echo "Input BAM: ${INPUT_BAM_PATH}"
 
+# --- 3. Execution: Both REDItools3 Calls Run Concurrently ---
+# The two analyses read the same BAM but are otherwise independent, so they run side by side
+# with the task's cores split between them instead of one after the other.
+THREADS=${SLURM_CPUS_PER_TASK:-1}
+MAIN_THREADS=$(( (THREADS + 1) / 2 ))
+AEI_THREADS=$(( THREADS - MAIN_THREADS ))
+if [ "$AEI_THREADS" -lt 1 ]; then AEI_THREADS=1; fi
+
+# Each call streams its own stdout/stderr to a log file next to its output, so the two runs do
+# not interleave in the SLURM log; the tail of a log is echoed back if its call fails
+MAIN_LOG="${OUTPUT_CALLS_FILE%.tsv}.reditools.log"
+AEI_LOG="${AEI_CALLS_FILE%.tsv}.reditools.log"
+
 # --- 3A. Execution: Call REDItools3 for Main edQTL Sites (Excluding Alu) ---
-echo "Running REDItools (MAIN edQTL: Excluding Master Blacklist)... Output: ${OUTPUT_CALLS_FILE}"
+echo "Running REDItools (MAIN edQTL: Excluding Master Blacklist, ${MAIN_THREADS} threads)... Output: ${OUTPUT_CALLS_FILE}"
 
 python3 -m reditools analyze \
-    "${INPUT_BAM_PATH}" \
-    --reference "${GENOME_FASTA}" \
-    --output-file "${OUTPUT_CALLS_FILE}" \
-    --threads ${SLURM_CPUS_PER_TASK} \
-    --min-read-quality 20 \
-    --min-base-quality 20 \
-    --min-read-depth 10 \
-    --min-edits 3 \
-    --exclude-regions "${MASTER_BLACKLIST_BED}" 
+    "${INPUT_BAM_PATH}" \
+    --reference "${GENOME_FASTA}" \
+    --output-file "${OUTPUT_CALLS_FILE}" \
+    --threads ${MAIN_THREADS} \
+    --min-read-quality 20 \
+    --min-base-quality 20 \
+    --min-read-depth 10 \
+    --min-edits 3 \
+    --exclude-regions "${MASTER_BLACKLIST_BED}" > "${MAIN_LOG}" 2>&1 &
+MAIN_PID=$!
 
 
 # --- 3B. Execution: Call REDItools3 for AEI Calculation (Alu ONLY) ---
-echo "Running REDItools (AEI: Alu ONLY)... Output: ${AEI_CALLS_FILE}"
+echo "Running REDItools (AEI: Alu ONLY, ${AEI_THREADS} threads)... Output: ${AEI_CALLS_FILE}"
 
 python3 -m reditools analyze \
-    "${INPUT_BAM_PATH}" \
-    --reference "${GENOME_FASTA}" \
-    --output-file "${AEI_CALLS_FILE}" \
-    --threads ${SLURM_CPUS_PER_TASK} \
-    --min-read-quality 20 \
-    --min-base-quality 20 \
-    --min-read-depth 10 \
-    --min-edits 3 \
-    --region "${ALU_ONLY_BED}" # <--- CRITICAL: --region only includes sites in the BED file
+    "${INPUT_BAM_PATH}" \
+    --reference "${GENOME_FASTA}" \
+    --output-file "${AEI_CALLS_FILE}" \
+    --threads ${AEI_THREADS} \
+    --min-read-quality 20 \
+    --min-base-quality 20 \
+    --min-read-depth 10 \
+    --min-edits 3 \
+    --region "${ALU_ONLY_BED}" > "${AEI_LOG}" 2>&1 & # <--- CRITICAL: --region only includes sites in the BED file
+AEI_PID=$!
 
 
 # --- 4. Final Verification and Gzip (Updated) ---
 
-if [ $? -ne 0 ]; then
-    echo "ERROR: One of the REDItools executions failed. Check log for details."
-    exit 1
+# set -e does not apply to background jobs: collect each exit status explicitly
+REDITOOLS_FAILED=0
+wait ${MAIN_PID} || { echo "ERROR: REDItools MAIN edQTL execution failed. Last lines of ${MAIN_LOG}:"; tail -n 200 "${MAIN_LOG}"; REDITOOLS_FAILED=1; }
+wait ${AEI_PID} || { echo "ERROR: REDItools AEI execution failed. Last lines of ${AEI_LOG}:"; tail -n 200 "${AEI_LOG}"; REDITOOLS_FAILED=1; }
+
+if [ "$REDITOOLS_FAILED" -ne 0 ]; then
+    echo "ERROR: One of the REDItools executions failed. Full logs: ${MAIN_LOG}, ${AEI_LOG}"
+    exit 1
 fi
 
 if [ ! -s "${OUTPUT_CALLS_FILE}" ] || [ ! -s "${AEI_CALLS_FILE}" ]; then
@@ -15,6 +15,8 @@
 #SBATCH --partition=bigmem
 # Reserve sufficient memory (Crucial for large concatenation step)
 #SBATCH --mem=128G 
+# Reserve CPUs for the parallel per-file loading step
+#SBATCH --cpus-per-task=16
 # Set time limit
 #SBATCH --time=12:00:00
 
@@ -32,6 +34,16 @@ OUTPUT_FILE="./phase5_edQTL_features/edQTL_features_all_genes_all_celltypes_p5.t
 # --- New Parameter: Sample Size Filter (Based on Li et al. 2022) ---
 MIN_SAMPLES=70 # Minimum number of non-missing samples required for a feature
 
+# Worker processes for loading the Phase 4 matrices
+THREADS=${SLURM_CPUS_PER_TASK:-1}
+
+# Set USE_PARQUET=1 to read the Parquet copies written by convert_phase4_to_parquet.py
+USE_PARQUET=${USE_PARQUET:-0}
+PARQUET_FLAG=""
+if [ "${USE_PARQUET}" -eq 1 ]; then
+    PARQUET_FLAG="--use_parquet"
+fi
+
 # --- Setup ---
 mkdir -p ./phase5_edQTL_features
 mkdir -p logs
@@ -44,13 +56,15 @@ echo "Starting Phase 5: Collation and Feature Selection"
 echo "Minimum Sample Filter (N): ${MIN_SAMPLES}"
 echo "Input Directory: ${INPUT_DIR}"
 echo "Output File: ${OUTPUT_FILE}"
+echo "Read Parquet inputs: ${USE_PARQUET}"
 
 # Run the Python script
 python3 ${SCRIPT} \
     --input_dir ${INPUT_DIR} \
     --file_pattern "${FILE_PATTERN}" \
     --output_file ${OUTPUT_FILE} \
-    --min_samples ${MIN_SAMPLES}
+    --min_samples ${MIN_SAMPLES} \
+    --threads ${THREADS} ${PARQUET_FLAG}
 
 # --- Success Flag ---
 if [ $? -eq 0 ]; then
@@ -17,6 +17,7 @@
 # --- Configuration ---
 SCRIPT="./Python_scripts/qvalue_filter_phase8.py"
 OUTPUT_DIR="./phase8_final_results"
+THREADS=${SLURM_CPUS_PER_TASK:-1}
 mkdir -p ${OUTPUT_DIR}
 
 # 1. edQTL Results (Phase 7)
@@ -42,7 +43,8 @@ echo "Starting Phase 8: FDR Correction and Lead SNP Identification"
 python3 ${SCRIPT} \
     --input_edqtl_results ${EDQTL_FILES} \
     --input_aeiqtl_results ${AEIQTL_FILES} \
-    --output_dir ${OUTPUT_DIR}
+    --output_dir ${OUTPUT_DIR} \
+    --threads ${THREADS}
 
 # --- Success Flag ---
 if [ $? -eq 0 ]; then